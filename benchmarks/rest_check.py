@@ -0,0 +1,50 @@
+"""
+Compares the ReST check of ValidREST with rendering the description to HTML,
+which is what it did before it only parsed it.
+
+    $ python benchmarks/rest_check.py
+"""
+
+import io
+import os
+import timeit
+
+from docutils.core import publish_parts
+from docutils.utils import SystemMessage
+
+from pyroma import ratings
+
+README = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "README.rst")
+
+
+def render(source):
+    try:
+        publish_parts(source=source, writer="html4css1", settings_overrides={"warning_stream": io.StringIO()})
+    except SystemMessage:
+        pass
+
+
+def best(function, source, number, repeat):
+    return min(timeit.repeat(lambda: function(source), number=number, repeat=repeat)) / number
+
+
+def main():
+    with open(README, encoding="UTF-8") as readme:
+        readme_text = readme.read()
+    large = "Title\n=====\n\n" + "".join(
+        f"Paragraph {i} with *emphasis*, ``code`` and https://example.com/{i} in it.\n\n" for i in range(40000)
+    )
+    # Build the docutils settings before timing
+    ratings._check_rest(readme_text)
+
+    for name, source, number, repeat in (("README.rst", readme_text, 20, 5), ("large description", large, 1, 1)):
+        rendered = best(render, source, number, repeat)
+        parsed = best(ratings._check_rest, source, number, repeat)
+        print(
+            f"{name} ({len(source) / 1024:.0f} kB): rendering {rendered * 1000:.1f} ms, "
+            f"parsing {parsed * 1000:.1f} ms, {rendered / parsed:.1f} times faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,37 @@
+import importlib
+import json
 import logging
 import os
 import sys
 from argparse import ArgumentParser, ArgumentTypeError
-from pyroma import projectdata, distributiondata, pypidata, ratings
+from pyroma import cache, deadline
 
 logging.basicConfig(level=logging.DEBUG, stream=sys.stdout, format="%(message)s")
 
+# The other modules import docutils, build, setuptools or requests, which are
+# slow to import, so they are only imported when they are used, and each mode
+# only imports what it needs.
+SUBMODULES = {
+    "backendpool",
+    "batch",
+    "buildenv",
+    "deptree",
+    "distributiondata",
+    "history",
+    "httpcache",
+    "projectdata",
+    "pypidata",
+    "ratings",
+    "roles",
+}
+
+
+def __getattr__(name):
+    # So that pyroma.ratings and the like work without importing them first
+    if name in SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def zester(data):
     main_files = set(os.listdir(data["workingdir"]))
@@ -25,6 +51,36 @@ def zester(data):
                 sys.exit(1)
 
 
+def deadline_argument(arg):
+    try:
+        f = float(arg)
+    except ValueError:
+        raise ArgumentTypeError("Must be a number of seconds")
+    if f <= 0:
+        raise ArgumentTypeError("Must be more than zero seconds")
+    return f
+
+
+def positive_int_argument(arg):
+    try:
+        f = int(arg)
+    except ValueError:
+        raise ArgumentTypeError("Must be an integer")
+    if f < 1:
+        raise ArgumentTypeError("Must be at least 1")
+    return f
+
+
+def versions_argument(arg):
+    from packaging.specifiers import InvalidSpecifier, SpecifierSet
+
+    try:
+        SpecifierSet(arg)
+    except InvalidSpecifier:
+        raise ArgumentTypeError("Must be a version specifier, like '>=1.0,<2'")
+    return arg
+
+
 def min_argument(arg):
     try:
         f = int(arg)
@@ -40,6 +96,8 @@ def min_argument(arg):
 
 
 def get_all_tests():
+    from pyroma import ratings
+
     return [x.__class__.__name__ for x in ratings.ALL_TESTS]
 
 
@@ -80,7 +138,9 @@ def main():
     parser.color = True
     parser.add_argument(
         "package",
-        help="A python package, can be a directory, a distribution file or a PyPI package name.",
+        nargs="*",
+        help="A python package, can be a directory, a distribution file or a PyPI package name. "
+        "If you give more than one they are rated in parallel.",
     )
     parser.add_argument(
         "-n",
@@ -132,49 +192,333 @@ def main():
         default=False,
         help="Output only the rating",
     )
+    parser.add_argument(
+        "--discover",
+        action="store_true",
+        default=False,
+        help="Rate all projects with a pyproject.toml or setup.py in the given directories, "
+        "or in the current directory",
+    )
+    parser.add_argument(
+        "--dependencies",
+        action="store_true",
+        default=False,
+        help="Also rate the dependencies of the package from PyPI, and their dependencies, and show the tree",
+    )
+    parser.add_argument(
+        "--depth",
+        type=positive_int_argument,
+        help="How many levels of dependencies to rate with --dependencies, the default is all",
+    )
+    parser.add_argument(
+        "--all-versions",
+        action="store_true",
+        default=False,
+        help="Rate all the releases of the package from PyPI, and show how the rating changed",
+    )
+    parser.add_argument(
+        "--versions",
+        type=versions_argument,
+        help="Rate the releases of the package from PyPI that match this version specifier, like '>=1.0,<2'",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int_argument,
+        help="How many projects to rate in parallel, the default is the number of CPUs",
+    )
     parser.add_argument(
         "--skip-tests",
         type=skip_tests,
         help="Skip the named tests",
     )
+    parser.add_argument(
+        "--deadline",
+        type=deadline_argument,
+        help="Stop after this many seconds, and give a rating of what was checked so far. "
+        "When rating several projects, this is the time for all of them",
+    )
+    parser.add_argument(
+        "--check-static",
+        action="store_true",
+        default=False,
+        help="Compare the static metadata in pyproject.toml with what the build backend makes",
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        help="Install the requirements of isolated builds only from the wheels in this directory",
+    )
+    parser.add_argument(
+        "--index-url",
+        help="Get packages from this index instead of PyPI, a mirror with the layout of bandersnatch, "
+        "over HTTP or as a file:// url or directory",
+    )
+    parser.add_argument(
+        "--metadata-only",
+        action="store_true",
+        default=False,
+        help="Use the metadata files of the index (PEP 658), if it has them, instead of downloading and "
+        "building the sdist. It's then not checked if the sdist has a pyproject.toml",
+    )
+    parser.add_argument(
+        "--extract-dir",
+        help="Extract distributions in this directory, f ex a RAM backed one like /dev/shm",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=True,
+        help="Do not use or update the cache of package data",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        default=False,
+        help="Empty the cache before running",
+    )
+    parser.add_argument(
+        "--build-history",
+        action="store_true",
+        default=False,
+        help="Print which build strategy worked for the projects built so far, and exit",
+    )
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        default=False,
+        help="Print cache hits and misses after running",
+    )
 
     args = parser.parse_args()
 
-    mode = args.mode
-    if args.mode is None or args.mode == "auto":
-        if os.path.isdir(args.package):
-            mode = "directory"
-        elif os.path.isfile(args.package):
-            mode = "file"
-        else:
-            mode = "pypi"
+    cache.enable()
+    if args.clear_cache:
+        cache.clear()
+    if not args.cache:
+        cache.disable()
+    if args.wheelhouse:
+        from pyroma import buildenv
+
+        buildenv.set_wheelhouse(args.wheelhouse)
+    if args.extract_dir:
+        from pyroma import distributiondata
 
-    rating = run(mode, args.package, args.quiet, args.skip_tests)
-    if rating < args.min:
+        distributiondata.set_extract_dir(args.extract_dir)
+    if args.index_url:
+        from pyroma import pypidata
+
+        pypidata.set_index_url(args.index_url)
+    if args.metadata_only:
+        from pyroma import pypidata
+
+        pypidata.set_metadata_only(True)
+
+    if args.build_history:
+        from pyroma import projectdata
+
+        print(json.dumps(projectdata.build_history(), indent=2))
+        sys.exit(0)
+
+    if args.discover:
+        from pyroma import batch
+
+        projects = []
+        for directory in args.package or ["."]:
+            projects.extend(("directory", path) for path in batch.discover(directory))
+    elif not args.package:
+        parser.error("the following arguments are required: package")
+    else:
+        projects = [(get_mode(args.mode, package), package) for package in args.package]
+
+    if args.all_versions or args.versions:
+        if len(projects) != 1 or args.discover or args.dependencies or projects[0][0] != "pypi":
+            parser.error("--all-versions and --versions can only be used with one package from PyPI")
+        failed = run_history(
+            projects[0][1], args.versions, args.jobs, args.quiet, args.skip_tests, args.deadline, min_rating=args.min
+        )
+    elif args.dependencies:
+        if len(projects) != 1 or args.discover:
+            parser.error("--dependencies can only be used with one package")
+        mode, package = projects[0]
+        failed = run_tree(
+            mode, package, args.jobs, args.quiet, args.skip_tests, args.deadline, args.depth, min_rating=args.min
+        )
+    elif len(projects) == 1 and not args.discover:
+        mode, package = projects[0]
+        rating = run(mode, package, args.quiet, args.skip_tests, check_static=args.check_static, timeout=args.deadline)
+        failed = rating < args.min
+    else:
+        failed = run_many(projects, args.jobs, args.quiet, args.skip_tests, args.deadline, args.min)
+
+    if args.cache_stats:
+        for name, (hits, misses) in cache.stats().items():
+            print(f"Cache {name}: {hits} hits, {misses} misses")
+    if failed:
         sys.exit(2)
     sys.exit(0)
 
 
-def run(mode, argument, quiet=False, skip_tests=None):
+def get_mode(mode, package):
+    if mode is None or mode == "auto":
+        if os.path.isdir(package):
+            return "directory"
+        elif os.path.isfile(package):
+            return "file"
+        else:
+            return "pypi"
+    return mode
+
+
+def run_many(projects, jobs=None, quiet=False, skip_tests=None, timeout=None, min_rating=8):
+    """Rates many projects in parallel. Returns True if any of them got less than min_rating"""
+    from pyroma import batch
+
     if quiet:
         logger = logging.getLogger()
         logger.disabled = True
 
     logging.info("-" * 30)
-    logging.info("Checking " + argument)
+    logging.info(f"Checking {len(projects)} projects")
+    results = batch.run_batch(projects, jobs, skip_tests, timeout)
+    logging.info("-" * 30)
+    for line in batch.summary(results):
+        logging.info(line)
+    logging.info("-" * 30)
+
+    failed = [result for result in results if result[4] or result[2] < min_rating]
+    if quiet:
+        logger.disabled = False
+        for argument, name, rating, problems, error in results:
+            logging.info(f"{argument}: {'Error' if error else rating}")
+    else:
+        logging.info(f"{len(results) - len(failed)} of {len(results)} projects got a rating of {min_rating} or more")
+    return bool(failed)
+
+
+def run_tree(mode, argument, jobs=None, quiet=False, skip_tests=None, timeout=None, max_depth=None, min_rating=8):
+    """Rates a project and its dependencies. Returns True if any of them got less than min_rating"""
+    from pyroma import deptree
+
+    if quiet:
+        logger = logging.getLogger()
+        logger.disabled = True
+
+    logging.info("-" * 30)
+    logging.info(f"Checking {argument} and its dependencies")
+    root, nodes = deptree.rate_tree(mode, argument, jobs, skip_tests, timeout, max_depth)
+    logging.info("-" * 30)
+    for line in deptree.tree(root, nodes):
+        logging.info(line)
+    logging.info("-" * 30)
+
+    failed = [node for node in nodes.values() if node.error or node.rating < min_rating]
+    if quiet:
+        logger.disabled = False
+        for key, node in sorted(nodes.items()):
+            logging.info(f"{key}: {'Error' if node.error else node.rating}")
+    else:
+        logging.info(f"{len(nodes) - len(failed)} of {len(nodes)} projects got a rating of {min_rating} or more")
+    return bool(failed)
 
+
+def run_history(project, spec=None, jobs=None, quiet=False, skip_tests=None, timeout=None, min_rating=8):
+    """Rates the releases of a project. Returns True if the latest of them got less than min_rating"""
+    from pyroma import history
+
+    if quiet:
+        logger = logging.getLogger()
+        logger.disabled = True
+
+    logging.info("-" * 30)
+    logging.info(f"Checking the releases of {project}")
+    try:
+        name, releases = history.rate_history(project, spec, jobs, skip_tests, timeout)
+    except deadline.DeadlineExceeded as e:
+        if quiet:
+            logger.disabled = False
+        logging.info(f"{e}, so no releases were rated")
+        return True
+    logging.info("-" * 30)
+    for line in history.trend(releases):
+        logging.info(line)
+    logging.info("-" * 30)
+
+    if quiet:
+        logger.disabled = False
+        for release in releases:
+            logging.info(f"{release.version}: {'Error' if release.error else release.rating}")
+    if not releases:
+        logging.info(f"Found no releases of {name} to rate")
+        return True
+    latest = releases[-1]
+    if not quiet:
+        logging.info(f"The latest rated release, {name} {latest.version}, got {latest.rating}/10")
+    return bool(latest.error) or latest.rating < min_rating
+
+
+def run(mode, argument, quiet=False, skip_tests=None, check_static=False, timeout=None):
+    with deadline.limit(timeout):
+        return _run(mode, argument, quiet, skip_tests, check_static)
+
+
+def get_data(mode, argument, check_static=False, metadata_only=None):
     if mode == "directory":
-        data = projectdata.get_data(os.path.abspath(argument))
-        logging.info("Found " + data.get("name", "nothing"))
+        from pyroma import projectdata
+
+        if check_static:
+            differences = projectdata.compare_static_data(os.path.abspath(argument))
+            for difference in differences:
+                logging.info(difference)
+            if not differences:
+                logging.info("The static metadata is the same as the metadata from the build backend.")
+        return projectdata.get_data(os.path.abspath(argument))
     elif mode == "file":
-        data = distributiondata.get_data(os.path.abspath(argument))
-        logging.info("Found " + data.get("name", "nothing"))
+        from pyroma import distributiondata
+
+        return distributiondata.get_data(os.path.abspath(argument))
     else:
         # It's probably a package name
-        data = pypidata.get_data(argument)
-        logging.info("Found " + data.get("name", "nothing"))
+        from pyroma import pypidata
+
+        return pypidata.get_data(argument, metadata_only)
+
+
+def get_rating(mode, argument, skip_tests=None, check_static=False):
+    """Returns the data and the (rating, problems) of a project"""
+    from pyroma import ratings
+
+    try:
+        if mode == "file":
+            from pyroma import distributiondata
+
+            # The ratings of distribution files are cached
+            return distributiondata.get_rating(os.path.abspath(argument), skip_tests)
+        metadata_only = None
+        if mode != "directory":
+            from pyroma import pypidata
+
+            # If the tests that need the source tree are skipped, there is no need to build the sdist
+            if pypidata.SOURCE_TESTS <= set(skip_tests or []):
+                metadata_only = True
+        data = get_data(mode, argument, check_static, metadata_only)
+    except deadline.DeadlineExceeded as e:
+        data = {"_deadline_exceeded": e.phase}
+    return data, ratings.rate(data, skip_tests)
+
+
+def _run(mode, argument, quiet=False, skip_tests=None, check_static=False):
+    from pyroma import ratings
+
+    if quiet:
+        logger = logging.getLogger()
+        logger.disabled = True
+
+    logging.info("-" * 30)
+    logging.info("Checking " + argument)
 
-    rating = ratings.rate(data, skip_tests)
+    data, rating = get_rating(mode, argument, skip_tests, check_static)
+    logging.info("Found " + data.get("name", "nothing"))
 
     logging.info("-" * 30)
     for problem in rating[1]:
@@ -0,0 +1,205 @@
+"""
+A pool of warm build backend processes.
+
+Normally each build backend hook is run in a new Python process, which has to
+import the build backend, and that import often takes longer than the hook.
+When rating many projects, the pool instead keeps server processes running,
+one or more per Python executable and build backend, with the backend already
+imported. Each hook call is run in a fork of a server, so the hooks still
+can't affect each other.
+
+The pool is only used if enabled, and only where os.fork() exists.
+"""
+
+import atexit
+import json
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+
+import pyproject_hooks
+
+from pyroma import deadline
+
+# Restart a server after this many hook calls, in case the backend leaks
+MAX_TASKS = 100
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hookworker.py")
+
+# The environment variables the hook runners use to tell the hook which backend to use.
+# The PEP517 ones are from older versions of pyproject_hooks.
+BACKEND_ENVIRON = ("_PYPROJECT_HOOKS_BUILD_BACKEND", "PEP517_BUILD_BACKEND")
+BACKEND_PATH_ENVIRON = ("_PYPROJECT_HOOKS_BACKEND_PATH_JSON", "PEP517_BACKEND_PATH")
+
+_pool = None
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class Worker:
+    def __init__(self, python, backend, extra_environ):
+        env = os.environ.copy()
+        env.update(extra_environ)
+        self.tasks = 0
+        self.process = subprocess.Popen(
+            [python, WORKER_SCRIPT, backend],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            encoding="UTF-8",
+            # A process group of its own, so it can be killed with the hook it runs
+            start_new_session=True,
+        )
+
+    def run(self, cmd, cwd, extra_environ, timeout=None):
+        task = {"script": cmd[1], "args": list(cmd[2:]), "cwd": cwd or os.getcwd(), "env": dict(extra_environ)}
+        self.tasks += 1
+        try:
+            self.process.stdin.write(json.dumps(task) + "\n")
+            self.process.stdin.flush()
+            if timeout is not None:
+                ready = select.select([self.process.stdout], [], [], timeout)[0]
+                if not ready:
+                    self.kill()
+                    raise deadline.DeadlineExceeded("running the build backend")
+            line = self.process.stdout.readline()
+        except OSError as e:
+            raise WorkerCrashed(str(e))
+        if not line:
+            raise WorkerCrashed(f"The backend worker exited with {self.process.wait()}")
+        return json.loads(line)
+
+    def _close_pipes(self):
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        self._close_pipes()
+
+    def close(self):
+        # Closing stdin tells the server to exit
+        self._close_pipes()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class BackendPool:
+    def __init__(self, max_tasks=MAX_TASKS):
+        self.max_tasks = max_tasks
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _key(self, cmd, extra_environ):
+        return (cmd[0],) + tuple(sorted(extra_environ.items()))
+
+    def _new_worker(self, cmd, extra_environ):
+        backend = ""
+        if not any(name in extra_environ for name in BACKEND_PATH_ENVIRON):
+            # In-tree backends are project specific, so they are not imported in advance
+            backend = next((extra_environ[name] for name in BACKEND_ENVIRON if name in extra_environ), "")
+        return Worker(cmd[0], backend, extra_environ)
+
+    def _get_worker(self, key, cmd, extra_environ):
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop()
+        return self._new_worker(cmd, extra_environ)
+
+    def _release(self, key, worker):
+        if worker.tasks >= self.max_tasks:
+            worker.close()
+            return
+        with self._lock:
+            self._idle[key].append(worker)
+
+    def runner(self, cmd, cwd=None, extra_environ=None):
+        """A pyproject_hooks subprocess runner, that runs the hook in a worker"""
+        extra_environ = extra_environ or {}
+        key = self._key(cmd, extra_environ)
+
+        worker = self._get_worker(key, cmd, extra_environ)
+        try:
+            result = worker.run(cmd, cwd, extra_environ, deadline.remaining())
+        except WorkerCrashed:
+            # Try once more with a fresh worker, the crash might be the fault
+            # of an earlier hook.
+            worker.close()
+            worker = self._new_worker(cmd, extra_environ)
+            try:
+                result = worker.run(cmd, cwd, extra_environ, deadline.remaining())
+            except WorkerCrashed:
+                worker.close()
+                raise
+        self._release(key, worker)
+
+        if result["returncode"] != 0:
+            # Just like the subprocess runners in pyproject_hooks
+            raise subprocess.CalledProcessError(result["returncode"], cmd, output=result["output"].encode("UTF-8"))
+
+    def shutdown(self):
+        with self._lock:
+            workers = [worker for workers in self._idle.values() for worker in workers]
+            self._idle.clear()
+        for worker in workers:
+            worker.close()
+
+
+def is_supported():
+    return hasattr(os, "fork") and sys.platform != "win32"
+
+
+def enable(max_tasks=MAX_TASKS):
+    global _pool
+    if _pool is not None or not is_supported():
+        return
+    _pool = BackendPool(max_tasks)
+    atexit.register(_pool.shutdown)
+
+
+def disable():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        atexit.unregister(_pool.shutdown)
+        _pool = None
+
+
+def subprocess_runner(cmd, cwd=None, extra_environ=None):
+    """Like pyproject_hooks.quiet_subprocess_runner, but stops the hook when the deadline is reached"""
+    timeout = deadline.remaining()
+    if timeout is None:
+        return pyproject_hooks.quiet_subprocess_runner(cmd, cwd=cwd, extra_environ=extra_environ)
+
+    env = os.environ.copy()
+    if extra_environ:
+        env.update(extra_environ)
+    try:
+        subprocess.run(
+            cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        raise deadline.DeadlineExceeded("running the build backend")
+
+
+def get_runner():
+    """Returns the subprocess runner that the build backend hooks should be run with"""
+    if _pool is None:
+        return subprocess_runner
+    return _pool.runner
@@ -0,0 +1,138 @@
+"""
+Rating many projects at once, in a pool of processes.
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sys
+import warnings
+
+import pyroma
+from pyroma import backendpool, buildenv, cache, deadline, distributiondata, pypidata, roles
+
+# Directories that are never searched for projects
+SKIP_DIRS = {"build", "dist", "node_modules", "site-packages", "venv", "__pycache__"}
+
+
+def discover(path):
+    """Yields the directories under path that have a pyproject.toml or a setup.py"""
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(
+            d for d in dirs if d not in SKIP_DIRS and not d.startswith(".") and not d.endswith(".egg-info")
+        )
+        if "pyproject.toml" in files or "setup.py" in files:
+            yield root
+
+
+def _preload():
+    # Import everything that rating needs before the workers are forked, so
+    # that they share the imported modules instead of importing them again.
+    import build.util  # noqa: F401
+    import docutils.parsers.rst  # noqa: F401
+    import docutils.readers.standalone  # noqa: F401
+    from pyroma import projectdata  # noqa: F401
+
+
+def _init_worker(cache_dir, wheelhouse, extract_dir, index_url, metadata_only):
+    # The results are printed by the main process, so the output of the
+    # backends and other tools in the workers would only be noise.
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    sys.stdout = open(os.devnull, "w")
+    if cache_dir is None:
+        cache.disable()
+    else:
+        cache.enable(cache_dir)
+    buildenv.set_wheelhouse(wheelhouse)
+    distributiondata.set_extract_dir(extract_dir)
+    pypidata.set_index_url(index_url)
+    pypidata.set_metadata_only(metadata_only)
+    # Each worker keeps its build backends warm between the projects
+    backendpool.enable()
+
+
+def rate_one(mode, argument, skip_tests=None, end=None):
+    """Rates one project, and returns (argument, name, rating, problems, error)
+
+    end is the time.monotonic() time of the deadline of the whole batch.
+    """
+    try:
+        with deadline.limit_until(end):
+            data, (rating, problems) = pyroma.get_rating(mode, argument, skip_tests)
+    except Exception as e:
+        return argument, None, 0, [], f"{e.__class__.__name__}: {e}"
+    return argument, data.get("name"), rating, problems, None
+
+
+def _mp_context():
+    # Forking shares the imported modules with the workers. On macOS fork is
+    # not safe, and on Windows there is none.
+    if sys.platform != "darwin" and "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def run_batch(projects, jobs=None, skip_tests=None, timeout=None):
+    """Rates a list of (mode, argument) projects in parallel
+
+    Returns a list of the results from rate_one(), in the same order as projects.
+    The timeout is for the whole batch.
+    """
+    with deadline.limit(timeout):
+        return _run_batch(projects, jobs, skip_tests)
+
+
+def _run_batch(projects, jobs, skip_tests):
+    _preload()
+    # The owners of all the packages on PyPI are fetched in as few requests as
+    # possible, and the workers get them from the cache.
+    pypi_projects = [argument for mode, argument in projects if mode == "pypi"]
+    if pypi_projects and pypidata.get_index().is_pypi:
+        try:
+            roles.prefetch(pypi_projects)
+        except deadline.DeadlineExceeded:
+            # The projects are rated without the owners that weren't fetched in time
+            pass
+    # The workers are other processes, so they get the end time of the deadline
+    end = deadline.end()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=_mp_context(),
+        initializer=_init_worker,
+        initargs=(
+            cache.get_cache_dir(),
+            buildenv.get_wheelhouse(),
+            distributiondata.get_extract_dir(),
+            pypidata.get_index_url(),
+            pypidata.get_metadata_only(),
+        ),
+    ) as executor:
+        futures = {
+            executor.submit(rate_one, mode, argument, skip_tests, end): index
+            for index, (mode, argument) in enumerate(projects)
+        }
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            result = future.result()
+            results[futures[future]] = result
+            argument, name, rating, problems, error = result
+            if error:
+                logging.info(f"[{done}/{len(projects)}] {argument}: {error}")
+            else:
+                logging.info(f"[{done}/{len(projects)}] {argument}: {rating}/10")
+
+    return [results[index] for index in range(len(projects))]
+
+
+def summary(results):
+    """Returns the summary table as a list of lines"""
+    width = max([len(str(name or "")) for argument, name, rating, problems, error in results] + [7])
+    lines = [f"Rating  {'Project':<{width}}  Checked"]
+    for argument, name, rating, problems, error in results:
+        if error:
+            lines.append(f"{'Error':>6}  {'':<{width}}  {argument}: {error}")
+        else:
+            lines.append(f"{rating:>6}  {name or '':<{width}}  {argument}")
+    return lines
@@ -0,0 +1,236 @@
+"""
+Isolated build environments that are reused between builds.
+
+build creates a new virtualenv and installs the build requirements in it for
+every isolated build. Here the environments are instead kept in the cache
+directory, keyed on the build requirements, so all projects that use the same
+build backend share one environment. An environment is never changed after
+it's created, so requirements that the backend asks for when it builds a
+project are installed in another environment, keyed on all the requirements.
+Requirements can also be installed from a local wheelhouse directory, so no
+network access is needed.
+
+If the cache is disabled, the environment is temporary.
+"""
+
+import contextlib
+import importlib.metadata
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import venv
+
+import build
+import build.env
+from packaging.requirements import InvalidRequirement, Requirement
+
+from pyroma import cache, deadline
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# How often a locked environment is checked, when there is a deadline
+LOCK_POLL_INTERVAL = 0.1
+
+_wheelhouse = os.environ.get("PYROMA_WHEELHOUSE") or None
+
+
+def set_wheelhouse(path):
+    """Install build requirements only from the wheels in this directory"""
+    global _wheelhouse
+    _wheelhouse = os.path.abspath(path) if path else None
+
+
+def get_wheelhouse():
+    return _wheelhouse
+
+
+def normalize_requirements(requirements):
+    result = set()
+    for requirement in requirements:
+        try:
+            result.add(str(Requirement(requirement)))
+        except InvalidRequirement:
+            result.add(requirement.strip())
+    return sorted(result)
+
+
+def environment_key(requirements):
+    """The key of the environment, which changes if the requirements or the Python changes"""
+    return cache.make_key(
+        sys.implementation.cache_tag or sys.implementation.name,
+        sys.version,
+        sys.platform,
+        *normalize_requirements(requirements),
+    )
+
+
+def _flock(lockfile, operation):
+    """Waits for the lock, until the deadline"""
+    if deadline.remaining() is None:
+        fcntl.flock(lockfile, operation)
+        return
+    while True:
+        try:
+            fcntl.flock(lockfile, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            deadline.check("waiting for the isolated build environment")
+            time.sleep(LOCK_POLL_INTERVAL)
+
+
+@contextlib.contextmanager
+def _locked(path, shared=False):
+    """Makes sure only one process at a time creates an environment, and that no process uses it meanwhile"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "w") as lockfile:
+        _flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class CachedIsolatedEnv(build.env.IsolatedEnv):
+    """An isolated environment that may already have the requirements installed"""
+
+    def __init__(self, path, shared=True):
+        self.path = path
+        self.shared = shared
+        self._record = os.path.join(path, "pyroma-requirements.json")
+
+    def lock(self, shared=False):
+        if not self.shared:
+            return contextlib.nullcontext()
+        return _locked(self.path + ".lock", shared)
+
+    @property
+    def scripts_dir(self):
+        return os.path.join(self.path, "Scripts" if os.name == "nt" else "bin")
+
+    @property
+    def python_executable(self):
+        return os.path.join(self.scripts_dir, "python.exe" if os.name == "nt" else "python")
+
+    def make_extra_environ(self):
+        # The same as build's DefaultIsolatedEnv
+        path = os.environ.get("PATH")
+        return {
+            "PATH": os.pathsep.join([self.scripts_dir, path]) if path is not None else self.scripts_dir,
+            "PYTHONPATH": "",
+        }
+
+    def exists(self):
+        """If the environment has been created, and the requirements installed"""
+        return os.path.isfile(self._record)
+
+    def create(self):
+        deadline.check("creating an isolated build environment")
+        venv.EnvBuilder(with_pip=True, symlinks=os.name != "nt").create(self.path)
+
+    def installed(self):
+        try:
+            with open(self._record, encoding="UTF-8") as recordfile:
+                return set(json.load(recordfile))
+        except (OSError, ValueError):
+            return set()
+
+    def _write_record(self, requirements):
+        with open(self._record, "w", encoding="UTF-8") as recordfile:
+            json.dump(sorted(requirements), recordfile)
+
+    def install(self, requirements):
+        requirements = set(normalize_requirements(requirements))
+        installed = self.installed()
+        missing = requirements - installed
+        if not missing:
+            if not self.exists():
+                self._write_record(requirements)
+            return
+
+        cmd = [
+            self.python_executable,
+            "-m",
+            "pip",
+            "install",
+            "--disable-pip-version-check",
+            "--no-warn-script-location",
+            "--no-input",
+            "--quiet",
+        ]
+        if _wheelhouse is not None:
+            cmd.extend(["--no-index", "--find-links", _wheelhouse])
+        cmd.extend(sorted(missing))
+
+        try:
+            result = subprocess.run(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="UTF-8", timeout=deadline.remaining()
+            )
+        except subprocess.TimeoutExpired:
+            raise deadline.DeadlineExceeded("installing build requirements")
+        if result.returncode != 0:
+            raise build.BuildException(f"Failed to install {', '.join(sorted(missing))}:\n{result.stdout}")
+        self._write_record(installed | missing)
+
+
+@contextlib.contextmanager
+def isolated_env(requirements):
+    """Yields an isolated environment with the requirements installed"""
+    envs_dir = cache.get_directory("buildenvs")
+    if envs_dir is None:
+        path = tempfile.mkdtemp(prefix="pyroma-build-env-")
+        try:
+            env = CachedIsolatedEnv(path, shared=False)
+            env.create()
+            env.install(requirements)
+            yield env
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+        return
+
+    env = CachedIsolatedEnv(os.path.join(envs_dir, environment_key(requirements)))
+    if not env.exists():
+        with env.lock():
+            if not env.exists():
+                # Remove the remains of an interrupted attempt
+                shutil.rmtree(env.path, ignore_errors=True)
+                env.create()
+                env.install(requirements)
+    # Other processes can use the environment at the same time, but can't recreate it
+    with env.lock(shared=True):
+        yield env
+
+
+def _metadata(builder):
+    with tempfile.TemporaryDirectory() as tempdir:
+        metadata_path = pathlib.Path(builder.metadata_path(tempdir))
+        return importlib.metadata.PathDistribution(metadata_path).metadata
+
+
+def project_wheel_metadata(path, runner):
+    """Like build.util.project_wheel_metadata(path, isolated=True), but with a reused environment"""
+    requirements = set(build.ProjectBuilder(path).build_system_requires)
+    with isolated_env(requirements) as env:
+        builder = build.ProjectBuilder.from_isolated_env(env, path, runner=runner)
+        extra_requirements = set(builder.get_requires_for_build("wheel"))
+        if set(normalize_requirements(extra_requirements)) <= set(normalize_requirements(requirements)):
+            return _metadata(builder)
+        if not env.shared:
+            # A temporary environment is only used for this build
+            env.install(extra_requirements)
+            return _metadata(builder)
+
+    # The shared environment is not changed, as other projects with the same
+    # build requirements would then be built with these requirements too
+    with isolated_env(requirements | extra_requirements) as env:
+        builder = build.ProjectBuilder.from_isolated_env(env, path, runner=runner)
+        return _metadata(builder)
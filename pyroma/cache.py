@@ -0,0 +1,210 @@
+"""
+A small persistent cache, used to avoid redoing expensive work, like running
+the build backend, between pyroma runs.
+
+The cache is disabled by default when pyroma is used as a library, and is
+enabled by the pyroma script unless you pass --no-cache. Each kind of data
+is stored in a separate namespace, as one JSON file per key.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+_cache_dir = None
+_caches = {}
+
+
+def default_cache_dir():
+    if os.environ.get("PYROMA_CACHE_DIR"):
+        return os.environ["PYROMA_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pyroma")
+
+
+def enable(path=None):
+    global _cache_dir
+    _cache_dir = os.path.abspath(path or default_cache_dir())
+
+
+def disable():
+    global _cache_dir
+    _cache_dir = None
+
+
+def is_enabled():
+    return _cache_dir is not None
+
+
+def get_cache_dir():
+    return _cache_dir
+
+
+def get_cache(name, max_size=None):
+    if name not in _caches:
+        _caches[name] = Cache(name)
+    if max_size is not None:
+        _caches[name].max_size = max_size
+    return _caches[name]
+
+
+def get_directory(name):
+    """Returns a directory in the cache, for caches that aren't JSON data"""
+    if _cache_dir is None:
+        return None
+    path = os.path.join(_cache_dir, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def clear():
+    """Remove everything in all the caches"""
+    if _cache_dir is None or not os.path.isdir(_cache_dir):
+        return
+    for name in os.listdir(_cache_dir):
+        get_cache(name).clear()
+
+
+def stats():
+    return {name: (cache.hits, cache.misses) for name, cache in sorted(_caches.items())}
+
+
+@functools.cache
+def pyroma_version():
+    # importlib.metadata is slow to import, and only needed for the cache keys
+    import importlib.metadata
+
+    try:
+        return importlib.metadata.version("pyroma")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def make_key(*parts):
+    """Makes a cache key from strings or bytes"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("UTF-8")
+        # Prefix with the length, so ("ab", "c") and ("a", "bc") differ
+        digest.update(str(len(part)).encode("ascii") + b":" + part)
+    return digest.hexdigest()
+
+
+class Cache:
+    """A namespace in the cache
+
+    If max_size is set, the least recently used entries are removed when the
+    files in the namespace get larger than that many bytes.
+    """
+
+    def __init__(self, name, max_size=None):
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        if _cache_dir is None:
+            return None
+        return os.path.join(_cache_dir, self.name)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _load(self, key):
+        try:
+            with open(self._filename(key), encoding="UTF-8") as cachefile:
+                return json.load(cachefile)
+        except (OSError, ValueError):
+            # Missing or corrupt, which is the same thing for a cache.
+            return None
+
+    def get(self, key):
+        if _cache_dir is None:
+            return None
+        value = self._load(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.max_size is not None:
+            # The modification time is used as the time of last use
+            try:
+                os.utime(self._filename(key))
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value):
+        if _cache_dir is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file and rename it, so that concurrent pyroma
+        # runs never see a half-written entry.
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="UTF-8") as cachefile:
+                json.dump(value, cachefile)
+            os.replace(tmpname, self._filename(key))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def evict(self, max_size):
+        """Removes the least recently used entries until the total size is at most max_size bytes"""
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        entries = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        for mtime, size, filename in sorted(entries):
+            if total <= max_size:
+                break
+            self.delete(filename[:-5])
+            total -= size
+
+    def items(self):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith(".json"):
+                # Listing the entries doesn't count as using them
+                value = self._load(filename[:-5])
+                if value is not None:
+                    yield filename[:-5], value
+
+    def delete(self, key):
+        if _cache_dir is None:
+            return
+        try:
+            os.unlink(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
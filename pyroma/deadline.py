@@ -0,0 +1,80 @@
+"""
+A time budget for a pyroma run.
+
+The budget is shared by all the phases of a run: fetching data from PyPI,
+extracting the distribution, running the build backend and rating. Each phase
+asks for the remaining time, and is stopped with DeadlineExceeded when there
+is none left. The deadline is stored in a context variable, so it doesn't have
+to be passed around, and code running without a deadline is not affected.
+Threads get it with a copy of the context, and other processes with the end
+time, which is a time.monotonic() time, so all share the same budget.
+"""
+
+import contextlib
+import contextvars
+import time
+
+_current = contextvars.ContextVar("pyroma_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, phase):
+        super().__init__(f"Ran out of time while {phase}")
+        self.phase = phase
+
+
+class Deadline:
+    def __init__(self, end):
+        self.end = end
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.end
+
+
+def limit(seconds):
+    """Runs the code in the with statement with a time budget"""
+    return limit_until(None if seconds is None else time.monotonic() + seconds)
+
+
+@contextlib.contextmanager
+def limit_until(end):
+    """Runs the code in the with statement with a deadline at the time.monotonic() time end"""
+    if end is None:
+        yield None
+        return
+    current = Deadline(end)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+
+
+def end():
+    """Returns the time.monotonic() time of the deadline, or None if there is no deadline"""
+    current = _current.get()
+    if current is None:
+        return None
+    return current.end
+
+
+def remaining():
+    """Returns the remaining time in seconds, or None if there is no deadline"""
+    current = _current.get()
+    if current is None:
+        return None
+    return current.remaining()
+
+
+def expired():
+    current = _current.get()
+    return current is not None and current.expired()
+
+
+def check(phase):
+    """Raises DeadlineExceeded if the time is up"""
+    if expired():
+        raise DeadlineExceeded(phase)
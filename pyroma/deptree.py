@@ -0,0 +1,137 @@
+"""
+Rating a project and everything it depends on.
+
+The requirements in the requires-dist metadata of the project are looked up
+on PyPI, and then their requirements, and so on. Each project is rated only
+once, however many projects depend on it, and the projects are rated in
+parallel, in threads, as the network and the build backends are the slow
+parts.
+"""
+
+import collections
+import concurrent.futures
+import contextvars
+import logging
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+import pyroma
+from pyroma import deadline, pypidata, roles
+
+Node = collections.namedtuple("Node", "name rating problems error requires")
+
+
+def requirements(data):
+    """Returns the names of the projects that the data requires
+
+    Requirements that are only for extras, or for other Pythons or platforms,
+    are not included.
+    """
+    requires = data.get("requires-dist") or []
+    if isinstance(requires, str):
+        requires = [requires]
+    names = set()
+    for requirement in requires:
+        try:
+            requirement = Requirement(requirement)
+        except InvalidRequirement:
+            continue
+        if requirement.marker is not None and not requirement.marker.evaluate({"extra": ""}):
+            continue
+        names.add(canonicalize_name(requirement.name))
+    return sorted(names)
+
+
+def rate_node(mode, argument, skip_tests=None):
+    try:
+        data, (rating, problems) = pyroma.get_rating(mode, argument, skip_tests)
+    except Exception as e:
+        return Node(argument, 0, [], f"{e.__class__.__name__}: {e}", [])
+    return Node(data.get("name") or argument, rating, problems, None, requirements(data))
+
+
+def rate_tree(mode, argument, jobs=None, skip_tests=None, timeout=None, max_depth=None):
+    """Rates a project and its dependencies, down to max_depth levels
+
+    Returns the key of the project and a dictionary of all the rated
+    projects, with canonicalized project names as keys and Nodes as values.
+    The timeout is for the whole tree.
+    """
+    with deadline.limit(timeout):
+        return _rate_tree(mode, argument, jobs, skip_tests, max_depth)
+
+
+def _rate_tree(mode, argument, jobs, skip_tests, max_depth):
+    nodes = {}
+    pending = {}
+    seen = set()
+    root = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def submit(mode, argument, depth):
+            # Each thread gets a copy of the context, for the deadline
+            future = executor.submit(contextvars.copy_context().run, rate_node, mode, argument, skip_tests)
+            pending[future] = (argument, depth)
+
+        submit(mode, argument, 0)
+        while pending:
+            done, ignored = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                argument, depth = pending.pop(future)
+                node = future.result()
+                if depth == 0:
+                    root = canonicalize_name(node.name) if node.error is None else argument
+                    seen.add(root)
+                    key = root
+                else:
+                    key = argument
+                nodes[key] = node
+                if node.error:
+                    logging.info(f"[{len(nodes)}] {key}: {node.error}")
+                else:
+                    logging.info(f"[{len(nodes)}] {key}: {node.rating}/10")
+
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                new = [name for name in node.requires if name not in seen]
+                seen.update(new)
+                if new and pypidata.get_index().is_pypi:
+                    # Look up the owners of all the new dependencies in one request
+                    try:
+                        roles.prefetch(new)
+                    except deadline.DeadlineExceeded:
+                        pass
+                for name in new:
+                    submit("pypi", name, depth + 1)
+
+    return root, nodes
+
+
+def tree(root, nodes):
+    """Returns the dependency tree as a list of lines
+
+    The dependencies of a project are only listed the first time it's in the
+    tree, and projects that weren't rated because of the max depth are left out.
+    """
+    lines = []
+    shown = set()
+
+    def add(key, prefix, child_prefix):
+        node = nodes[key]
+        label = f"{node.name}: {node.error}" if node.error else f"{node.name} {node.rating}/10"
+        children = [child for child in node.requires if child in nodes]
+        if key in shown and children:
+            lines.append(f"{prefix}{label} (dependencies listed above)")
+            return
+        lines.append(prefix + label)
+        shown.add(key)
+        for index, child in enumerate(children):
+            if index == len(children) - 1:
+                add(child, child_prefix + "`-- ", child_prefix + "    ")
+            else:
+                add(child, child_prefix + "|-- ", child_prefix + "|   ")
+
+    add(root, "", "")
+    return lines
@@ -1,8 +1,17 @@
 """
-Extract information from a distribution file by unpacking in a temporary
-directory and then using projectdata on that.
+Extract information from a distribution file.
+
+Wheels have the finished metadata in .dist-info/METADATA, which is read
+directly from the wheel. If the PKG-INFO of an sdist has static metadata
+(PEP 643), that is also read directly from the archive. Otherwise the archive
+is unpacked in a temporary directory, and projectdata builds the metadata
+from that. Large files that the build is unlikely to need are not unpacked,
+and the directory can be on a RAM backed file system, set with
+$PYROMA_EXTRACT_DIR.
 """
 
+import hashlib
+import importlib.metadata
 import os
 import pathlib
 import shutil
@@ -10,41 +19,292 @@ import tarfile
 import tempfile
 import zipfile
 
-from pyroma import projectdata
+import docutils
+
+from pyroma import cache, deadline, projectdata, ratings
+
+TAR_EXTENSIONS = (".bz2", ".tbz", "tb2", ".gz", ".tgz", ".tar")
+ZIP_EXTENSIONS = (".zip", ".egg")
+
+# The files in the root of the sdist that are read without extracting it
+METADATA_FILES = ("PKG-INFO", "pyproject.toml", "setup.cfg")
+# Larger files than this are not metadata files, whatever their names are
+MAX_METADATA_SIZE = 10 * 1024 * 1024
+
+# Files larger than this, like binaries, test data and documentation, are not
+# extracted before building, unless they look like something the build needs.
+# If the build fails without them, the whole distribution is extracted.
+# The size can be set with $PYROMA_SKIP_SIZE, and None or 0 extracts everything.
+SKIP_SIZE = int(os.environ.get("PYROMA_SKIP_SIZE") or 1024 * 1024) or None
+KEEP_SUFFIXES = (".py", ".toml", ".cfg", ".in")
+KEEP_PREFIXES = ("README", "LICENSE", "LICENCE", "COPYING", "CHANGE", "HISTORY", "NEWS")
+
+_extract_dir = os.environ.get("PYROMA_EXTRACT_DIR") or None
+
+# The cache of the data and ratings of distribution files is kept below this
+# many bytes, by removing the least recently used entries.
+CACHE_SIZE = 64 * 1024 * 1024
+
+
+def set_extract_dir(path):
+    """Extract distributions in this directory, f ex a RAM backed one like /dev/shm"""
+    global _extract_dir
+    _extract_dir = os.path.abspath(path) if path else None
+
+
+def get_extract_dir():
+    return _extract_dir
+
+
+def _needed(name, size):
+    """Returns False for large files that building the metadata doesn't need"""
+    if SKIP_SIZE is None or size <= SKIP_SIZE:
+        return True
+    filename = name.rstrip("/").split("/")[-1]
+    return filename.endswith(KEEP_SUFFIXES) or filename.upper().startswith(KEEP_PREFIXES)
+
+
+def _extract_tar(path, tempdir, skip=True):
+    """Validates and extracts a tar file in one pass over it
+
+    Returns True if any files were skipped.
+    """
+    root = pathlib.Path(tempdir).resolve()
+    skipped = set()
+    with tarfile.open(name=path, mode="r:*") as tar_file:
+        # Iterating over the tar file reads it as a stream, member by member
+        for member in tar_file:
+            deadline.check("extracting the distribution")
+            if skip and (
+                (member.isfile() and not _needed(member.name, member.size))
+                or (member.islnk() and member.linkname in skipped)
+            ):
+                skipped.add(member.name)
+                continue
+
+            if hasattr(tarfile, "data_filter"):
+                try:
+                    tar_file.extract(member, tempdir, filter="data")
+                except tarfile.FilterError as e:
+                    raise Exception(f"Attempted path traversal in tar file {tar_file.name!r}: {e}")
+            else:
+                # Fix CVE-2007-4559 for Pythons without the extraction filters
+                member_path = (root / member.name).resolve()
+                if root not in member_path.parents:
+                    raise Exception(f"Attempted path traversal in tar file {tar_file.name!r}")
+                tar_file.extract(member, tempdir)
+    return bool(skipped)
+
+
+def _extract_zip(path, tempdir, skip=True):
+    """Extracts a zip file, returns True if any files were skipped"""
+    skipped = False
+    with zipfile.ZipFile(path, mode="r") as zip_file:
+        for member in zip_file.infolist():
+            deadline.check("extracting the distribution")
+            if skip and not member.is_dir() and not _needed(member.filename, member.file_size):
+                skipped = True
+                continue
+            # ZipFile.extract() removes absolute paths and ".." from the names
+            zip_file.extract(member, tempdir)
+    return skipped
+
+
+def read_wheel_metadata(wheel):
+    """Returns the text of the .dist-info/METADATA file in a wheel
+
+    The wheel can be a path or a file object.
+    """
+    with zipfile.ZipFile(wheel, mode="r") as zip_file:
+        for name in zip_file.namelist():
+            parts = name.split("/")
+            if len(parts) == 2 and parts[0].endswith(".dist-info") and parts[1] == "METADATA":
+                return zip_file.read(name).decode("UTF-8", errors="replace")
+    raise ValueError("The wheel has no .dist-info/METADATA file")
+
+
+def get_wheel_data(wheel):
+    return projectdata.parse_metadata(read_wheel_metadata(wheel))
+
+
+def read_metadata_files(path, basename, ext):
+    """Reads the metadata files in the root of an sdist in one pass, without extracting it
+
+    Returns a dictionary with the contents of the METADATA_FILES that exist.
+    """
+    wanted = {f"{basename}/{name}": name for name in METADATA_FILES}
+    files = {}
+    if ext in TAR_EXTENSIONS:
+        with tarfile.open(name=path, mode="r:*") as tar_file:
+            # Iterating over the tar file reads it as a stream, member by member
+            for member in tar_file:
+                deadline.check("reading the distribution")
+                name = wanted.get(member.name)
+                if name is not None and member.isfile() and member.size <= MAX_METADATA_SIZE:
+                    files[name] = tar_file.extractfile(member).read()
+                    if len(files) == len(wanted):
+                        break
+    else:
+        with zipfile.ZipFile(path, mode="r") as zip_file:
+            for member in zip_file.infolist():
+                name = wanted.get(member.filename)
+                if name is not None and member.file_size <= MAX_METADATA_SIZE:
+                    files[name] = zip_file.read(member)
+    return files
+
+
+def get_pkg_info_data(files):
+    """Returns the data from the PKG-INFO, if it can be trusted to be the same as a build would give
+
+    That's the case from Metadata-Version 2.2 (PEP 643), if none of the fields pyroma checks are dynamic.
+    """
+    if "PKG-INFO" not in files:
+        return None
+    data = projectdata.parse_metadata(files["PKG-INFO"].decode("UTF-8", errors="replace"))
+    try:
+        metadata_version = tuple(int(part) for part in data.get("metadata-version", "").split("."))
+    except ValueError:
+        return None
+    if metadata_version < (2, 2):
+        return None
+
+    dynamic = data.get("dynamic", [])
+    if isinstance(dynamic, str):
+        dynamic = [dynamic]
+    if {projectdata.normalize(field) for field in dynamic} & projectdata.CHECKED_FIELDS:
+        return None
+
+    if "pyproject.toml" not in files:
+        data["_missing_pyproject_toml"] = True
+    return data
+
+
+def file_digest(path):
+    """Returns the sha256 of a file, as a hex string"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as distfile:
+        for chunk in iter(lambda: distfile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(digest):
+    """The cache key of a distribution file, which changes with the pyroma and classifier versions"""
+    try:
+        classifiers_version = importlib.metadata.version("trove-classifiers")
+    except importlib.metadata.PackageNotFoundError:
+        classifiers_version = "unknown"
+    return cache.make_key(digest, cache.pyroma_version(), classifiers_version)
+
+
+def rating_key(skip_tests):
+    """The key of a rating in the cache entry of a file, which changes with the skipped tests and the docutils version
+
+    The data of a file doesn't depend on docutils, but the ValidREST result does.
+    """
+    return cache.make_key(docutils.__version__, *sorted(skip_tests or []))
+
 
+def _cacheable(data):
+    return not data.get("_wheel_build_failed") and not data.get("_deadline_exceeded")
 
-def _safe_extract_tar(tar, path=".", members=None, numeric_owner=False):
-    """Safely extract a tar w/o traversing parent dirs to fix CVE-2007-4559."""
-    root = pathlib.Path(path).resolve()
-    for member in tar.getmembers():
-        member_path = (root / member.name).resolve()
-        if root not in member_path.parents:
-            raise Exception(f"Attempted path traversal in tar file {tar.name!r}")
-    tar.extractall(path, members, numeric_owner=numeric_owner)
 
+def get_data(path, digest=None):
+    """Returns the metadata of a distribution file
+
+    When the cache is enabled, it's keyed on the sha256 of the file, which can
+    be passed in as digest if it's known already.
+    """
+    if not cache.is_enabled():
+        return _get_data(path)
+
+    key = cache_key(digest or file_digest(path))
+    distribution_cache = cache.get_cache("distributions", CACHE_SIZE)
+    entry = distribution_cache.get(key)
+    if entry is not None:
+        return entry["data"]
+
+    data = _get_data(path)
+    if _cacheable(data):
+        distribution_cache.set(key, {"data": data, "ratings": {}})
+    return data
 
-def get_data(path):
+
+def get_cached_data(digest):
+    """Returns the cached metadata of the distribution file with this sha256, or None"""
+    if not cache.is_enabled():
+        return None
+    entry = cache.get_cache("distributions", CACHE_SIZE).get(cache_key(digest))
+    return None if entry is None else entry["data"]
+
+
+def get_rating(path, skip_tests=None, digest=None):
+    """Returns the data and the (rating, problems) of a distribution file
+
+    An unchanged file that has been rated before is not extracted or built,
+    and not even rated again, when the cache is enabled.
+    """
+    if not cache.is_enabled():
+        data = _get_data(path)
+        return data, ratings.rate(data, skip_tests)
+
+    key = cache_key(digest or file_digest(path))
+    skip_key = rating_key(skip_tests)
+    distribution_cache = cache.get_cache("distributions", CACHE_SIZE)
+    entry = distribution_cache.get(key)
+    if entry is not None and skip_key in entry["ratings"]:
+        rating, problems = entry["ratings"][skip_key]
+        return entry["data"], (rating, problems)
+
+    if entry is None:
+        entry = {"data": _get_data(path), "ratings": {}}
+    data = entry["data"]
+    rating = ratings.rate(data, skip_tests)
+    # A rating that ran out of time is not complete
+    if _cacheable(data) and not deadline.expired():
+        entry["ratings"][skip_key] = list(rating)
+        distribution_cache.set(key, entry)
+    return data, rating
+
+
+def _get_data(path):
     filename = os.path.split(path)[-1]
     basename, ext = os.path.splitext(filename)
     if basename.endswith(".tar"):
         basename, ignored = os.path.splitext(basename)
+    if ext == ".whl":
+        return get_wheel_data(path)
+    if ext not in TAR_EXTENSIONS + ZIP_EXTENSIONS:
+        raise ValueError("Unknown file type: " + ext)
 
-    tempdir = tempfile.mkdtemp()
-    try:
-        if ext in (".bz2", ".tbz", "tb2", ".gz", ".tgz", ".tar"):
-            with tarfile.open(name=path, mode="r:*") as tar_file:
-                _safe_extract_tar(tar_file, path=tempdir)
+    data = get_pkg_info_data(read_metadata_files(path, basename, ext))
+    if data is not None:
+        return data
+
+    # The metadata must be built, so extract the distribution
+    return get_build_data(path, basename, ext)
 
-        elif ext in (".zip", ".egg"):
-            with zipfile.ZipFile(path, mode="r") as zip_file:
-                zip_file.extractall(tempdir)
 
+def get_build_data(path, basename, ext):
+    data, skipped = _get_build_data(path, basename, ext, skip=True)
+    if skipped and data.get("_wheel_build_failed"):
+        # Maybe the build needed one of the skipped files
+        data, skipped = _get_build_data(path, basename, ext, skip=False)
+    return data
+
+
+def _get_build_data(path, basename, ext, skip):
+    tempdir = tempfile.mkdtemp(dir=_extract_dir)
+    try:
+        if ext in TAR_EXTENSIONS:
+            skipped = _extract_tar(path, tempdir, skip)
         else:
-            raise ValueError("Unknown file type: " + ext)
+            skipped = _extract_zip(path, tempdir, skip)
 
+        deadline.check("extracting the distribution")
         projectpath = os.path.join(tempdir, basename)
-        data = projectdata.get_build_data(projectpath)
+        data = projectdata.get_build_data(projectpath, temporary=True)
     finally:
         shutil.rmtree(tempdir, ignore_errors=True)
 
-    return data
+    return data, skipped
@@ -0,0 +1,140 @@
+"""
+Rating the releases of a project on PyPI, to see how the quality changes.
+
+The project data is fetched from the index once, as it lists the files of
+all the releases, and each release is rated from its own files, in parallel,
+in threads. The downloads and the data of the files are cached like when
+rating only the latest release, so rating the history again is fast.
+"""
+
+import collections
+import concurrent.futures
+import contextvars
+import logging
+
+from packaging.specifiers import SpecifierSet
+from packaging.version import InvalidVersion, Version
+
+from pyroma import deadline, pypidata, ratings
+
+Release = collections.namedtuple("Release", "version date rating problems error")
+
+
+def select_releases(project_data, spec=None):
+    """Returns the releases that match the version specifier, oldest first
+
+    Pre-releases are included, and releases without files, or with versions
+    that aren't valid, are left out.
+    """
+    spec = SpecifierSet(spec or "")
+    versions = []
+    for release, urls in project_data["releases"].items():
+        if not urls:
+            continue
+        try:
+            version = Version(release)
+        except InvalidVersion:
+            logging.debug(f"Skipping the invalid version {release}")
+            continue
+        if spec.contains(version, prereleases=True):
+            versions.append((version, release))
+    return [release for version, release in sorted(versions)]
+
+
+def release_date(urls):
+    """Returns the date of the first upload of a release, as YYYY-MM-DD"""
+    times = [download.get("upload_time_iso_8601") or download.get("upload_time") or "" for download in urls]
+    first = min(times, default="")
+    return first[:10]
+
+
+def rate_release(project_data, release, index, owners=None, skip_tests=None, metadata_only=False):
+    """Rates one release, owners is a function that returns the owners of the project, or None"""
+    date = release_date(project_data["releases"][release])
+    try:
+        data = pypidata.get_release_data(project_data, release, index, metadata_only)
+    except deadline.DeadlineExceeded as e:
+        data = {"_deadline_exceeded": e.phase}
+    except Exception as e:
+        return Release(release, date, 0, [], f"{e.__class__.__name__}: {e}")
+    project_owners = None if owners is None else owners()
+    if project_owners is not None:
+        data["_owners"] = project_owners
+    rating, problems = ratings.rate(data, skip_tests)
+    return Release(release, date, rating, problems, None)
+
+
+def rate_history(project, spec=None, jobs=None, skip_tests=None, timeout=None, metadata_only=None):
+    """Rates the releases of a project that match the version specifier
+
+    Returns the name of the project and a list of Releases, oldest first.
+    The timeout is for all the releases.
+    """
+    with deadline.limit(timeout):
+        return _rate_history(project, spec, jobs, skip_tests, metadata_only)
+
+
+def _rate_history(project, spec, jobs, skip_tests, metadata_only):
+    if metadata_only is None:
+        # If the tests that need the source tree are skipped, there is no need to build the sdists
+        metadata_only = True if pypidata.SOURCE_TESTS <= set(skip_tests or []) else pypidata.get_metadata_only()
+    index = pypidata.get_index()
+    project_data = pypidata._get_project_data(project, index)
+    name = project_data["info"]["name"]
+    selected = select_releases(project_data, spec)
+    logging.debug(f"Found {len(selected)} releases of {name}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # The owners are the same for all releases, so they are only fetched
+        # once, in the first thread, while the other threads fetch the releases.
+        roles_future = executor.submit(contextvars.copy_context().run, index.roles, project)
+
+        def owners():
+            try:
+                roles = roles_future.result()
+            except deadline.DeadlineExceeded:
+                # The owners are unknown, like for indexes that don't have them
+                return None
+            return None if roles is None else pypidata.owners(roles)
+
+        futures = {}
+        for release in selected:
+            # Each thread gets a copy of the context, for the deadline
+            future = executor.submit(
+                contextvars.copy_context().run,
+                rate_release,
+                project_data,
+                release,
+                index,
+                owners,
+                skip_tests,
+                metadata_only,
+            )
+            futures[future] = release
+        results = {}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if result.error:
+                logging.info(f"[{len(results)}/{len(selected)}] {result.version}: {result.error}")
+            else:
+                logging.info(f"[{len(results)}/{len(selected)}] {result.version}: {result.rating}/10")
+
+    return name, [results[release] for release in selected]
+
+
+def trend(releases):
+    """Returns a table of the ratings of the releases, and how they changed, as a list of lines"""
+    width = max([len("Version")] + [len(release.version) for release in releases])
+    lines = [f"{'Version':<{width}}  {'Released':<10}  Rating  Change"]
+    previous = None
+    for release in releases:
+        if release.error:
+            lines.append(f"{release.version:<{width}}  {release.date:<10}  Error: {release.error}")
+            continue
+        change = ""
+        if previous is not None and release.rating != previous:
+            change = f"{release.rating - previous:+d}"
+        lines.append(f"{release.version:<{width}}  {release.date:<10}  {release.rating:>2}/10   {change}".rstrip())
+        previous = release.rating
+    return lines
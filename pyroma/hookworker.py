@@ -0,0 +1,83 @@
+"""
+The server process of the backend pool, see pyroma.backendpool.
+
+This is run as a script, possibly by the Python of an isolated build
+environment, so it must only use the standard library.
+
+It imports the build backend once, and then forks a child process for each
+hook call it gets on stdin. The child runs the hook script just like
+`python script hook_name control_dir` would, but without the cost of
+starting Python and importing the backend. The result is written as one line
+of JSON per call on the original stdout.
+"""
+
+import importlib
+import json
+import os
+import runpy
+import sys
+import tempfile
+
+
+def run_task(task):
+    with tempfile.TemporaryFile() as output:
+        pid = os.fork()
+        if pid == 0:
+            # The child runs the hook, with its output captured
+            returncode = 1
+            try:
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, 0)
+                os.dup2(output.fileno(), 1)
+                os.dup2(output.fileno(), 2)
+                os.chdir(task["cwd"])
+                os.environ.update(task["env"])
+                sys.argv = [task["script"]] + task["args"]
+                runpy.run_path(task["script"], run_name="__main__")
+                returncode = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    returncode = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                import traceback
+
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(returncode)
+
+        status = os.waitpid(pid, 0)[1]
+        output.seek(0)
+        return {
+            "returncode": os.waitstatus_to_exitcode(status),
+            "output": output.read().decode("UTF-8", errors="replace"),
+        }
+
+
+def main():
+    # Don't let modules next to this script shadow the backend's imports
+    sys.path.pop(0)
+
+    # Keep the real stdout for the results, anything else printed goes to stderr.
+    results = os.fdopen(os.dup(1), "w", encoding="UTF-8")
+    os.dup2(2, 1)
+
+    backend = sys.argv[1] if len(sys.argv) > 1 else ""
+    if backend:
+        try:
+            importlib.import_module(backend.split(":")[0])
+        except Exception:
+            # The hook will report this properly
+            pass
+
+    for line in sys.stdin:
+        result = run_task(json.loads(line))
+        results.write(json.dumps(result) + "\n")
+        results.flush()
+
+
+if __name__ == "__main__":
+    main()
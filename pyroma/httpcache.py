@@ -0,0 +1,199 @@
+"""
+HTTP requests with a shared session and a conditional request cache.
+
+All requests go through one requests.Session, so connections to PyPI are
+kept open and reused between requests, and failed requests are retried with
+a backoff. When there is a deadline, there are no retries, as they would
+each wait for the whole remaining time. Responses that have an ETag or Last-Modified header can be stored
+in the pyroma cache. The next request for the same URL then asks the server
+if it has changed, and if the server answers 304 Not Modified, the stored
+response is used.
+
+RemoteFile is a file object for a file on a server, that only fetches the
+parts of the file that are read, so zipfile can read one file in a large
+remote zip file.
+"""
+
+import io
+import os
+import re
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+from requests.structures import CaseInsensitiveDict
+
+from pyroma import cache, deadline
+
+RETRIES = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "HEAD"),
+    # Return the last response instead of raising an error, the callers check the status
+    raise_on_status=False,
+)
+POOL_SIZE = 10
+
+# The sessions with and without retries
+_sessions = {}
+
+
+def get_session():
+    """Returns the shared session, which doesn't retry failed requests if there is a deadline"""
+    retries = deadline.remaining() is None
+    session = _sessions.get(retries)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=RETRIES if retries else 0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["User-Agent"] = f"pyroma/{cache.pyroma_version()} {requests.utils.default_user_agent()}"
+        session = _sessions.setdefault(retries, session)
+    return session
+
+
+def reset_session():
+    """Closes the sessions, the next request will make a new one"""
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
+
+
+def _forget_session():
+    _sessions.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    # A forked process must not use the connections of its parent
+    os.register_at_fork(after_in_child=_forget_session)
+
+
+def _cached_response(url, entry):
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = "OK"
+    response.url = url
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = entry["encoding"]
+    response._content = entry["content"].encode("UTF-8", errors="surrogateescape")
+    return response
+
+
+def get(url, timeout=None, conditional=False, headers=None):
+    """Makes a GET request with the shared session
+
+    If conditional is true, the response is cached, and the next request for
+    the url is a conditional request. It's meant for API responses, the
+    content is stored as text.
+    """
+    headers = dict(headers or {})
+    http_cache = cache.get_cache("http")
+    # The headers are part of the key, as the Accept header can change the response
+    key = cache.make_key(url, *(f"{name}: {value}" for name, value in sorted(headers.items())))
+    entry = http_cache.get(key) if conditional else None
+
+    if entry is not None:
+        if entry["headers"].get("ETag"):
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if entry["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+
+    response = get_session().get(url, headers=headers, timeout=timeout)
+    if entry is not None and response.status_code == 304:
+        return _cached_response(url, entry)
+
+    if (
+        conditional
+        and response.status_code == 200
+        and ("ETag" in response.headers or "Last-Modified" in response.headers)
+    ):
+        http_cache.set(
+            key,
+            {
+                "headers": {
+                    name: response.headers[name]
+                    for name in ("Content-Type", "ETag", "Last-Modified")
+                    if name in response.headers
+                },
+                "encoding": response.encoding,
+                # Bytes that aren't UTF-8 survive the round trip as surrogates
+                "content": response.content.decode("UTF-8", errors="surrogateescape"),
+            },
+        )
+    return response
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class RemoteFile(io.RawIOBase):
+    """A read only file object that fetches the parts of a remote file that are read with Range requests
+
+    The end of the file is fetched when it's opened, as that's where zip files
+    have their table of contents. Raises RangeNotSupported if the server
+    doesn't support Range requests.
+    """
+
+    def __init__(self, url, timeout=None, block_size=64 * 1024):
+        super().__init__()
+        self.url = url
+        self.timeout = timeout
+        self.block_size = block_size
+        self.requests = 0
+        self._pos = 0
+        # The parts of the file that have been fetched, as (start, data)
+        self._blocks = []
+        start, data, self.size = self._fetch(f"bytes=-{block_size}")
+        self._blocks.append((start, data))
+
+    def _fetch(self, byte_range):
+        self.requests += 1
+        with get_session().get(self.url, headers={"Range": byte_range}, timeout=self.timeout, stream=True) as response:
+            if response.status_code != 206:
+                if response.ok:
+                    raise RangeNotSupported(f"{self.url} doesn't support Range requests")
+                response.raise_for_status()
+            match = re.match(r"bytes (\d+)-(\d+)/(\d+)", response.headers.get("Content-Range", ""))
+            if match is None:
+                raise RangeNotSupported(f"{self.url} has no Content-Range")
+            return int(match.group(1)), response.content, int(match.group(3))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self._pos
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), self.size)
+        if end <= self._pos:
+            return 0
+        for start, data in self._blocks:
+            if start <= self._pos and end <= start + len(data):
+                break
+        else:
+            # Fetch at least a block, so that small reads after each other
+            # don't make a request each.
+            fetch_end = min(max(end, self._pos + self.block_size), self.size) - 1
+            start, data, size = self._fetch(f"bytes={self._pos}-{fetch_end}")
+            self._blocks.append((start, data))
+        first, last = self._pos - start, end - start
+        chunk = data[first:last]
+        buffer[: len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
@@ -1,12 +1,20 @@
 # Extracts information from a project
-import build
-import build.util
+import importlib.metadata
 import os
 import pathlib
 import re
+import time
 
-from setuptools.config.setupcfg import read_configuration
-from distutils.errors import DistutilsFileError
+from packaging.markers import Marker
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.version import InvalidVersion, Version
+
+from pyroma import backendpool, cache, deadline
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
 # MAP from old setup.py type keys to Core Metadata keys
 METADATA_MAP = {
@@ -20,33 +28,166 @@ METADATA_MAP = {
 }
 
 
+# The fields in the [project] table that pyroma doesn't check, so they may be dynamic.
+# The dependencies are not among them, as they are in the requires-dist and provides-extra fields.
+UNCHECKED_FIELDS = {"scripts", "gui-scripts", "entry-points"}
+
+# The Core Metadata fields that the ratings look at, and the static
+# metadata therefore must get right.
+CHECKED_FIELDS = {
+    "name",
+    "version",
+    "summary",
+    "description",
+    "description-content-type",
+    "classifier",
+    "requires-python",
+    "keywords",
+    "author",
+    "author-email",
+    "maintainer",
+    "maintainer-email",
+    "home-page",
+    "project-url",
+    "license",
+    "license-expression",
+    "requires-dist",
+    "provides-extra",
+}
+
+README_CONTENT_TYPES = {
+    ".md": "text/markdown",
+    ".rst": "text/x-rst",
+    ".txt": "text/plain",
+}
+
+
 def normalize(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
-def wheel_metadata(path, isolated=None):
+def _wheel_metadata(path, isolated):
+    # build and the build environments are only imported when something is built
+    import build.util
+
+    from pyroma import buildenv
+
+    runner = backendpool.get_runner()
+    if isolated:
+        # Reuses the isolated environments, instead of making a new one each time
+        return buildenv.project_wheel_metadata(path, runner=runner)
+    return build.util.project_wheel_metadata(path, isolated=False, runner=runner)
+
+
+def _build_requirements_key(path):
+    from pyroma import buildenv
+
+    build_system = load_pyproject(path).get("build-system", {})
+    backend = build_system.get("build-backend", "setuptools.build_meta:__legacy__")
+    # The default if there is no build-system, see PEP 518
+    requirements = build_system.get("requires", ["setuptools>=40.8.0"])
+    return backend, cache.make_key(backend, *buildenv.normalize_requirements(requirements))
+
+
+def _preferred_isolation(path, requirements_key, temporary=False):
+    """Returns if isolation worked the last time, for this project or another with the same build requirements"""
+    history = cache.get_cache("buildhistory")
+    keys = [cache.make_key("backend", requirements_key)]
+    if not temporary:
+        keys.insert(0, cache.make_key("project", os.path.abspath(path)))
+    for key in keys:
+        record = history.get(key)
+        # If the build requirements changed, the record is no longer valid
+        if record is not None and record["requirements"] == requirements_key:
+            return record["isolated"]
+    # Try without build isolation first for efficiency
+    return False
+
+
+def _record_isolation(path, backend, requirements_key, isolated, seconds, temporary=False):
+    history = cache.get_cache("buildhistory")
+    record = {
+        "path": os.path.abspath(path),
+        "backend": backend,
+        "requirements": requirements_key,
+        "isolated": isolated,
+        "seconds": round(seconds, 3),
+    }
+    if not temporary:
+        # A temporary directory is never built again, so only the backend is recorded
+        history.set(cache.make_key("project", record["path"]), record)
+    history.set(cache.make_key("backend", requirements_key), dict(record, path=None))
+
+
+def build_history():
+    """Returns the recorded build strategies, per project and per build backend"""
+    return [record for key, record in cache.get_cache("buildhistory").items()]
+
+
+def wheel_metadata(path, isolated=None, temporary=False):
+    """Builds the metadata, temporary is true if path is an extracted distribution that is removed after"""
+    import build
+
     # If explictly specified whether to use isolation, pass it directly
     if isolated is not None:
-        return build.util.project_wheel_metadata(path, isolated=isolated)
+        return _wheel_metadata(path, isolated)
 
-    # Otherwise, try without build isolation first for efficiency
-    try:
-        return build.util.project_wheel_metadata(path, isolated=False)
-    # If building with build isolation fails, e.g. missing build deps, try with it
-    except (build.BuildException, build.BuildBackendException):
-        return build.util.project_wheel_metadata(path, isolated=True)
+    # Otherwise, start with what worked last time, and if that fails, try the other
+    backend, requirements_key = _build_requirements_key(path)
+    first = _preferred_isolation(path, requirements_key, temporary)
+    for isolated in (first, not first):
+        start = time.monotonic()
+        try:
+            metadata = _wheel_metadata(path, isolated)
+        except (build.BuildException, build.BuildBackendException):
+            # build wraps all errors, so check if it failed because the time ran out
+            deadline.check("running the build backend")
+            # F ex the build dependencies are not installed, so try with build isolation instead
+            if isolated != first:
+                raise
+            continue
+        if cache.is_enabled():
+            _record_isolation(path, backend, requirements_key, isolated, time.monotonic() - start, temporary)
+        return metadata
 
 
-def build_metadata(path, isolated=None):
+def build_metadata(path, isolated=None, temporary=False):
+    import build
+
     try:
-        metadata = wheel_metadata(path, isolated)
+        metadata = wheel_metadata(path, isolated, temporary)
     except build.BuildBackendException:
+        deadline.check("running the build backend")
         # The backend failed spectacularily. This happens with old packages,
         # when we can't build a wheel. It's not always a fatal error. F ex, if
         # you are getting info for a package from PyPI, we already have the
         # metadata from PyPI, we just couldn't get the additional build data.
         return {"_wheel_build_failed": True}
 
+    return normalize_metadata(metadata)
+
+
+class MetadataDistribution(importlib.metadata.Distribution):
+    """A distribution that has nothing but the metadata text, f ex read from a PKG-INFO"""
+
+    def __init__(self, text):
+        self._text = text
+
+    def read_text(self, filename):
+        if filename in ("METADATA", "PKG-INFO"):
+            return self._text
+        return None
+
+    def locate_file(self, path):
+        raise FileNotFoundError(path)
+
+
+def parse_metadata(text):
+    """Parses a PKG-INFO or METADATA file into the same data as build_metadata()"""
+    return normalize_metadata(MetadataDistribution(text).metadata)
+
+
+def normalize_metadata(metadata):
     # As far as I can tell, we can't trust that the builders normalize the keys,
     # so we do it here. Definitely most builders do not lower case them, which
     # Core Metadata Specs recommend.
@@ -72,15 +213,242 @@ def build_metadata(path, isolated=None):
     return data
 
 
-def get_build_data(path, isolated=None):
-    metadata = build_metadata(path, isolated=isolated)
+def load_pyproject(path):
+    try:
+        with open(os.path.join(path, "pyproject.toml"), "rb") as tomlfile:
+            return tomllib.load(tomlfile)
+    except (OSError, tomllib.TOMLDecodeError):
+        return {}
+
+
+def backend_version(backend):
+    """Returns the installed version of a build backend, like "flit_core.buildapi" """
+    top_level = backend.split(":")[0].split(".")[0]
+    try:
+        return importlib.metadata.version(top_level)
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    # The distribution name isn't the module name, f ex poetry-core
+    for dist in importlib.metadata.packages_distributions().get(top_level, []):
+        try:
+            return importlib.metadata.version(dist)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return "unknown"
+
+
+# Files that often hold a version number read dynamically by the build backend
+VERSION_FILES = {"__init__.py", "__about__.py", "__version__.py", "_version.py", "version.py"}
+
+
+def _metadata_inputs(path):
+    """Yields the files that could affect the metadata of a project
+
+    This is all the files in the project root (setup.py, setup.cfg, pyproject.toml,
+    README and other files the description may be made from), files in the
+    packages that commonly hold the version number, and the current git
+    commit, as that's what setuptools-scm and friends use.
+    """
+    root = pathlib.Path(path)
+    for entry in sorted(root.iterdir()):
+        if entry.is_file():
+            yield entry
+        elif entry.is_dir() and not entry.name.startswith("."):
+            dirs = [entry]
+            if entry.name == "src":
+                dirs = sorted(d for d in entry.iterdir() if d.is_dir())
+            for directory in dirs:
+                for name in sorted(VERSION_FILES):
+                    if (directory / name).is_file():
+                        yield directory / name
+
+    git_head = root / ".git" / "HEAD"
+    if git_head.is_file():
+        yield git_head
+        head = git_head.read_text(encoding="UTF-8", errors="replace")
+        if head.startswith("ref:"):
+            ref = root / ".git" / head[4:].strip()
+            if ref.is_file():
+                yield ref
+
+
+def metadata_cache_key(path):
+    backend = load_pyproject(path).get("build-system", {}).get("build-backend", "setuptools.build_meta:__legacy__")
+    parts = [cache.pyroma_version(), backend, backend_version(backend)]
+    for filename in _metadata_inputs(path):
+        parts.append(str(filename.relative_to(path)))
+        parts.append(filename.read_bytes())
+    return cache.make_key(*parts)
+
+
+def get_build_data(path, isolated=None, temporary=False):
+    metadata_cache = cache.get_cache("metadata")
+    if cache.is_enabled():
+        key = metadata_cache_key(path)
+        metadata = metadata_cache.get(key)
+        if metadata is not None:
+            return metadata
+
+    metadata = build_metadata(path, isolated=isolated, temporary=temporary)
     # Check if there is a pyproject_toml
     if "pyproject.toml" not in os.listdir(path):
         metadata["_missing_pyproject_toml"] = True
+
+    if cache.is_enabled() and not metadata.get("_wheel_build_failed"):
+        # Failed builds are not cached, they may be caused by a temporary problem,
+        # like network trouble when installing build dependencies.
+        metadata_cache.set(key, metadata)
     return metadata
 
 
+def _people(people):
+    """Splits PEP 621 authors or maintainers into a names and an emails field"""
+    names = []
+    emails = []
+    for person in people:
+        if "email" in person:
+            if "name" in person:
+                emails.append(f"{person['name']} <{person['email']}>")
+            else:
+                emails.append(person["email"])
+        elif "name" in person:
+            names.append(person["name"])
+    return ", ".join(names), ", ".join(emails)
+
+
+def _extra_requirement(requirement, extra):
+    try:
+        req = Requirement(requirement)
+    except InvalidRequirement:
+        return None
+    if req.marker is None:
+        req.marker = Marker(f'extra == "{extra}"')
+    else:
+        req.marker = Marker(f'({req.marker}) and extra == "{extra}"')
+    return str(req)
+
+
+def static_metadata(pyproject, read_file):
+    """Makes Core Metadata from the [project] table of a pyproject.toml
+
+    This is what a PEP 621 compliant backend would make, but only for the
+    fields pyroma looks at. Returns None if the backend is needed, because
+    checked fields are dynamic or can't be interpreted without the backend.
+    `read_file` is called with a path relative to the project and should
+    return the text of that file, or None if it doesn't exist.
+    """
+    project = pyproject.get("project")
+    if not isinstance(project, dict) or "name" not in project or "version" not in project:
+        return None
+    if not set(project.get("dynamic", [])) <= UNCHECKED_FIELDS:
+        return None
+
+    try:
+        version = str(Version(project["version"]))
+    except (InvalidVersion, TypeError):
+        # Let the backend deal with this.
+        return None
+
+    data = {"name": project["name"], "version": version}
+    if "description" in project:
+        data["summary"] = project["description"]
+
+    readme = project.get("readme")
+    if readme is not None:
+        if isinstance(readme, str):
+            content_type = README_CONTENT_TYPES.get(os.path.splitext(readme)[1].lower())
+            text = read_file(readme)
+        else:
+            content_type = readme.get("content-type")
+            text = read_file(readme["file"]) if "file" in readme else readme.get("text")
+        if content_type is None or text is None:
+            return None
+        data["description-content-type"] = content_type
+        if text.strip():
+            data["description"] = text
+
+    if "requires-python" in project:
+        data["requires-python"] = project["requires-python"]
+
+    license = project.get("license")
+    if isinstance(license, str):
+        data["license-expression"] = license
+    elif isinstance(license, dict):
+        text = read_file(license["file"]) if "file" in license else license.get("text")
+        if text is None:
+            return None
+        data["license"] = text
+
+    for field, key in (("authors", "author"), ("maintainers", "maintainer")):
+        names, emails = _people(project.get(field, []))
+        if names:
+            data[key] = names
+        if emails:
+            data[key + "-email"] = emails
+
+    if project.get("keywords"):
+        data["keywords"] = ",".join(project["keywords"])
+    if project.get("classifiers"):
+        data["classifier"] = list(project["classifiers"])
+    if project.get("urls"):
+        data["project-url"] = [f"{label}, {url}" for label, url in project["urls"].items()]
+
+    requirements = list(project.get("dependencies", []))
+    extras = project.get("optional-dependencies", {})
+    for extra, extra_requirements in extras.items():
+        for requirement in extra_requirements:
+            requirement = _extra_requirement(requirement, extra)
+            if requirement is None:
+                return None
+            requirements.append(requirement)
+    if requirements:
+        data["requires-dist"] = requirements
+    if extras:
+        data["provides-extra"] = list(extras)
+
+    # Like build_metadata, single values are not lists
+    for key, value in data.items():
+        if isinstance(value, list) and len(value) == 1:
+            data[key] = value[0]
+
+    return data
+
+
+def get_static_data(path):
+    def read_file(filename):
+        try:
+            return (pathlib.Path(path) / filename).read_text(encoding="UTF-8")
+        except OSError:
+            return None
+
+    return static_metadata(load_pyproject(path), read_file)
+
+
+def compare_static_data(path):
+    """Returns a list of the differences between the static and the built metadata"""
+    static = get_static_data(path)
+    if static is None:
+        return ["The metadata in pyproject.toml is dynamic, so the build backend must be used."]
+
+    built = build_metadata(path)
+    differences = []
+    for key in sorted(CHECKED_FIELDS):
+        static_value = static.get(key)
+        built_value = built.get(key)
+        if key == "description" and static_value and built_value:
+            # Backends differ in how many newlines they add at the end
+            static_value = static_value.rstrip()
+            built_value = built_value.rstrip()
+        if static_value != built_value:
+            differences.append(
+                f"{key}: pyproject.toml has {static.get(key)!r}, but the build backend gives {built.get(key)!r}"
+            )
+    return differences
+
+
 def get_setupcfg_data(path):
+    from setuptools.config.setupcfg import read_configuration
+
     data = read_configuration(str(pathlib.Path(path) / "setup.cfg"))
 
     metadata = {}
@@ -107,10 +475,21 @@ def get_data(path):
 
 
 def _get_data(path):
+    # If everything is in the [project] table, we don't need the backend
+    data = get_static_data(path)
+    if data is not None:
+        return data
+
+    import build
+
     try:
         return get_build_data(path)
     except build.BuildException as e:
         if "no pyproject.toml or setup.py" in e.args[0]:
+            # setuptools is imported first, as it provides distutils on newer Pythons
+            import setuptools  # noqa: F401
+            from distutils.errors import DistutilsFileError
+
             # It couldn't build the package, because there is no setup.py or pyproject.toml.
             # Let's see if there is a setup.cfg:
             try:
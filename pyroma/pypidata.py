@@ -1,11 +1,34 @@
+import concurrent.futures
+import contextvars
+import hashlib
+import html.parser
+import json
 import logging
 import os
 import re
 import requests
+import shutil
 import tempfile
-import xmlrpc.client
+import urllib.parse
+import urllib.request
 
-from pyroma import distributiondata
+from pyroma import cache, deadline, distributiondata, httpcache, projectdata, roles
+
+DEFAULT_INDEX_URL = "https://pypi.org"
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+SIMPLE_ACCEPT = f"{SIMPLE_JSON}, text/html;q=0.1"
+
+# The tests that need the source tree of the sdist, and not only the metadata
+SOURCE_TESTS = {"MissingPyProjectToml"}
+
+# Downloads are streamed to disk this many bytes at a time, which is how
+# much of the file is in memory at once.
+CHUNK_SIZE = int(os.environ.get("PYROMA_DOWNLOAD_CHUNK_SIZE") or 1024 * 1024)
+# How many times an interrupted download is resumed
+DOWNLOAD_ATTEMPTS = 3
+
+_index_url = os.environ.get("PYROMA_INDEX_URL") or DEFAULT_INDEX_URL
+_metadata_only = False
 
 # MAP from old PyPI `info` keys to Core Metadata keys
 INFO_MAP = {
@@ -19,39 +42,429 @@ def normalize(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
-def _get_project_data(project):
+def _get(url, phase, conditional=False, headers=None):
+    """A GET request that is stopped when the deadline is reached"""
+    deadline.check(phase)
+    timeout = deadline.remaining()
+    try:
+        return httpcache.get(url, timeout=timeout, conditional=conditional, headers=headers)
+    except requests.Timeout:
+        if timeout is None:
+            raise
+        raise deadline.DeadlineExceeded(phase)
+    except requests.ConnectionError:
+        if not deadline.expired():
+            raise
+        raise deadline.DeadlineExceeded(phase)
+
+
+def _get_roles(project):
+    return roles.get_roles(project)
+
+
+def _range_start(response):
+    """Returns where the part of the file in a 206 response starts, or None if the Content-Range is missing"""
+    match = re.match(r"bytes (\d+)-\d+/(?:\d+|\*)$", response.headers.get("Content-Range", ""))
+    return None if match is None else int(match.group(1))
+
+
+def download_file(url, path, sha256=None):
+    """Streams url to path, and returns the sha256 of the file
+
+    The file is hashed while it's written, and if sha256 is given, the
+    download must match it. It's first written to path + ".part", and if that
+    exists, from an interrupted download, only the rest of the file is
+    downloaded.
+    """
+    phase = "downloading the distribution"
+    partial = path + ".part"
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, "rb") as partfile:
+                for chunk in iter(lambda: partfile.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    offset += len(chunk)
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        deadline.check(phase)
+        timeout = deadline.remaining()
+        try:
+            with httpcache.get_session().get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # The part is already complete, or it's not a part of this file
+                    if sha256 is not None and digest.hexdigest() == sha256:
+                        break
+                    os.unlink(partial)
+                    continue
+                if response.status_code not in (200, 206):
+                    raise ValueError(f"Unknown http error: {response.status_code} {response.reason}")
+                if response.status_code == 206 and _range_start(response) != offset:
+                    # F ex a proxy answered with another part of the file, so start from the beginning
+                    logging.debug(f"Got the wrong part of {url}, downloading all of it")
+                    os.unlink(partial)
+                    continue
+                if response.status_code == 200:
+                    # The server doesn't do ranges, start from the beginning
+                    digest = hashlib.sha256()
+                with open(partial, "ab" if response.status_code == 206 else "wb") as partfile:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        deadline.check(phase)
+                        digest.update(chunk)
+                        partfile.write(chunk)
+        except (requests.ConnectionError, requests.Timeout):
+            # The partial download is kept, so the next attempt can resume it
+            if deadline.expired():
+                raise deadline.DeadlineExceeded(phase)
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            logging.debug(f"Download of {url} was interrupted, resuming")
+            continue
+        break
+    else:
+        # Every attempt had to start again from the beginning
+        raise ValueError(f"Could not download {url}")
+
+    if sha256 is not None and digest.hexdigest() != sha256:
+        os.unlink(partial)
+        raise ValueError(f"The sha256 of {url} is {digest.hexdigest()}, but PyPI says it's {sha256}")
+    os.replace(partial, path)
+    return digest.hexdigest()
+
+
+def _get_distribution_data(url, sha256):
+    """Downloads a distribution file, and returns the data from it
+
+    With the cache enabled, the data for a known sha256 comes from the cache
+    without downloading anything, and interrupted downloads are kept there,
+    so the next run can resume them.
+    """
+    if sha256 is not None:
+        data = distributiondata.get_cached_data(sha256)
+        if data is not None:
+            return data
+
+    filename = url.split("/")[-1]
+    downloads = cache.get_directory("downloads")
+    if downloads is None or sha256 is None:
+        tempdir = tempfile.mkdtemp(prefix="pyroma-download-")
+    else:
+        tempdir = None
+    directory = tempdir or os.path.join(downloads, sha256)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    logging.debug(f"Downloading {filename} to verify distribution")
+    try:
+        digest = download_file(url, path, sha256)
+        return distributiondata.get_data(path, digest=digest)
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
+        elif os.path.exists(path):
+            # Only unfinished downloads are kept
+            os.unlink(path)
+
+
+class SimpleHTMLParser(html.parser.HTMLParser):
+    """Finds the files with PEP 658 metadata in a Simple API HTML page"""
+
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        attrs = dict(attrs)
+        # PEP 714 renamed the attribute, older indexes have the PEP 658 name
+        metadata = attrs.get("data-core-metadata", attrs.get("data-dist-info-metadata"))
+        if metadata is None or metadata == "false" or not attrs.get("href"):
+            return
+        filename = urllib.parse.urlparse(attrs["href"]).path.split("/")[-1]
+        hash_name, ignored, value = metadata.partition("=")
+        self.files[filename] = value if hash_name == "sha256" else None
+
+
+def _packages_path(url):
+    """Returns the part of a release file url after /packages/, where mirrors keep the files"""
+    path = urllib.parse.urlparse(url).path
+    if "/packages/" not in path:
+        return None
+    return path.split("/packages/", 1)[1]
+
+
+class HTTPIndex:
+    """An index with the PyPI JSON API, PyPI itself or a mirror served over HTTP
+
+    A mirror must have the layout of bandersnatch, with the JSON data in
+    pypi/<project>/json, and the release files in packages/.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.is_pypi = urllib.parse.urlparse(self.url).hostname == "pypi.org"
+        self.name = "PyPI" if self.is_pypi else self.url
+
+    def project_data(self, project):
+        response = _get(f"{self.url}/pypi/{project}/json", "fetching data from the index", conditional=True)
+        if response.status_code == 404:
+            raise ValueError(f"Did not find '{project}' on {self.name}. Did you misspell it?")
+        if not response.ok:
+            raise ValueError(f"Unknown http error: {response.status_code} {response.reason}")
+
+        return response.json()
+
+    def roles(self, project):
+        """Returns the roles of the users of the project, or None if the index doesn't know them"""
+        if not self.is_pypi:
+            # Mirrors don't have the XML-RPC API
+            return None
+        return _get_roles(project)
+
+    def _file_url(self, url):
+        if not self.is_pypi:
+            # The release file urls in the JSON data still point to PyPI
+            path = _packages_path(url)
+            if path is not None:
+                url = f"{self.url}/packages/{path}"
+        return url
+
+    def distribution_data(self, url, sha256):
+        return _get_distribution_data(self._file_url(url), sha256)
+
+    def core_metadata(self, project, urls):
+        """Returns {filename: sha256} for the files that have PEP 658 metadata, from the Simple API
+
+        The sha256 is None if the index doesn't say what it is.
+        """
+        response = _get(
+            f"{self.url}/simple/{normalize(project)}/",
+            "fetching the file list from the index",
+            conditional=True,
+            headers={"Accept": SIMPLE_ACCEPT},
+        )
+        if not response.ok:
+            return {}
+        if not response.headers.get("Content-Type", "").startswith(SIMPLE_JSON):
+            parser = SimpleHTMLParser()
+            parser.feed(response.text)
+            return parser.files
+
+        files = {}
+        for info in response.json().get("files", []):
+            # PEP 714 renamed the key, older indexes have the PEP 691 name
+            metadata = info.get("core-metadata", info.get("dist-info-metadata", False))
+            if metadata:
+                files[info["filename"]] = metadata.get("sha256") if isinstance(metadata, dict) else None
+        return files
+
+    def read_core_metadata(self, url):
+        response = _get(self._file_url(url) + ".metadata", "fetching the metadata")
+        if not response.ok:
+            raise ValueError(f"Unknown http error: {response.status_code} {response.reason}")
+        return response.content
+
+    def read_wheel_metadata(self, url, sha256):
+        """Reads the METADATA of a wheel, with Range requests for only the parts of the wheel that are needed"""
+        url = self._file_url(url)
+        phase = "fetching the metadata"
+        deadline.check(phase)
+        timeout = deadline.remaining()
+        try:
+            try:
+                return distributiondata.read_wheel_metadata(httpcache.RemoteFile(url, timeout=timeout))
+            except httpcache.RangeNotSupported:
+                pass
+        except requests.Timeout:
+            if timeout is None:
+                raise
+            raise deadline.DeadlineExceeded(phase)
+        except requests.ConnectionError:
+            if not deadline.expired():
+                raise
+            raise deadline.DeadlineExceeded(phase)
+
+        logging.debug(f"The index doesn't support Range requests, downloading {url.split('/')[-1]}")
+        with tempfile.TemporaryDirectory(prefix="pyroma-download-") as tempdir:
+            path = os.path.join(tempdir, url.split("/")[-1])
+            download_file(url, path, sha256)
+            return distributiondata.read_wheel_metadata(path)
+
+
+class FileIndex:
+    """A mirror on disk, with the layout of bandersnatch
+
+    The JSON data is in json/<project> or pypi/<project>/json and the release
+    files are in packages/. The mirror directory can also be the directory
+    above, that has the web/ directory.
+    """
+
+    is_pypi = False
+
+    def __init__(self, path):
+        if os.path.isdir(os.path.join(path, "web")):
+            path = os.path.join(path, "web")
+        self.path = path
+        self.name = path
+
+    def project_data(self, project):
+        for name in dict.fromkeys([project, normalize(project)]):
+            for filename in (os.path.join(self.path, "json", name), os.path.join(self.path, "pypi", name, "json")):
+                if os.path.isfile(filename):
+                    with open(filename, encoding="UTF-8") as jsonfile:
+                        return json.load(jsonfile)
+        raise ValueError(f"Did not find '{project}' in the mirror at {self.path}. Did you misspell it?")
+
+    def roles(self, project):
+        return None
+
+    def distribution_data(self, url, sha256):
+        path = _packages_path(url)
+        filename = None if path is None else os.path.join(self.path, "packages", *path.split("/"))
+        if filename is None or not os.path.isfile(filename):
+            raise ValueError(f"The mirror at {self.path} doesn't have {url}")
+        # The digest is not passed on, as the file is hashed if it's used as
+        # the cache key, so a broken file in the mirror can't poison the cache.
+        return distributiondata.get_data(filename)
+
+    def _metadata_filename(self, url):
+        path = _packages_path(url)
+        if path is None:
+            return None
+        return os.path.join(self.path, "packages", *path.split("/")) + ".metadata"
+
+    def core_metadata(self, project, urls):
+        files = {}
+        for download in urls:
+            filename = self._metadata_filename(download["url"])
+            if filename is not None and os.path.isfile(filename):
+                files[download["url"].split("/")[-1]] = None
+        return files
+
+    def read_core_metadata(self, url):
+        with open(self._metadata_filename(url), "rb") as metadatafile:
+            return metadatafile.read()
+
+    def read_wheel_metadata(self, url, sha256):
+        path = _packages_path(url)
+        filename = None if path is None else os.path.join(self.path, "packages", *path.split("/"))
+        if filename is None or not os.path.isfile(filename):
+            raise ValueError(f"The mirror at {self.path} doesn't have {url}")
+        return distributiondata.read_wheel_metadata(filename)
+
+
+def set_index_url(url):
+    """Use the index at this url instead of PyPI, a file:// url or a directory is a mirror on disk"""
+    global _index_url
+    _index_url = url or DEFAULT_INDEX_URL
+
+
+def get_index_url():
+    return _index_url
+
+
+def set_metadata_only(metadata_only):
+    """Only read the PEP 658 metadata of packages, if the index has it, instead of building the sdist"""
+    global _metadata_only
+    _metadata_only = metadata_only
+
+
+def get_metadata_only():
+    return _metadata_only
+
+
+def get_index():
+    if _index_url.startswith("file:"):
+        return FileIndex(urllib.request.url2pathname(urllib.parse.urlparse(_index_url).path))
+    if os.path.isdir(_index_url):
+        return FileIndex(_index_url)
+    return HTTPIndex(_index_url)
+
+
+def _get_project_data(project, index=None):
     # I think I should be able to monkeypatch a mock-thingy here... I think.
-    response = requests.get(f"https://pypi.org/pypi/{project}/json")
-    if response.status_code == 404:
-        raise ValueError(f"Did not find '{project}' on PyPI. Did you misspell it?")
-    if not response.ok:
-        raise ValueError(f"Unknown http error: {response.status_code} {response.reason}")
+    return (index or get_index()).project_data(project)
 
-    return response.json()
 
+def _get_core_metadata(index, project, urls):
+    """Returns the data from the PEP 658 metadata of the sdist or a wheel, or from the METADATA in a wheel
+
+    Returns None if there is no metadata file and no wheel.
+    """
+    available = index.core_metadata(project, urls)
+    # Prefer the metadata of the sdist, and the wheels have the same metadata
+    for download in sorted(urls, key=lambda download: download["packagetype"] != "sdist"):
+        filename = download["url"].split("/")[-1]
+        if filename not in available:
+            continue
+        content = index.read_core_metadata(download["url"])
+        sha256 = available[filename]
+        if sha256 is not None and hashlib.sha256(content).hexdigest() != sha256:
+            raise ValueError(f"The sha256 of the metadata of {filename} is wrong")
+        logging.debug(f"Read the metadata of {filename}")
+        return projectdata.parse_metadata(content.decode("UTF-8", errors="replace"))
+
+    # Without metadata files, read the metadata from inside a wheel
+    for download in urls:
+        if download["packagetype"] == "bdist_wheel":
+            text = index.read_wheel_metadata(download["url"], download.get("digests", {}).get("sha256"))
+            logging.debug(f"Read the metadata of {download['url'].split('/')[-1]}")
+            return projectdata.parse_metadata(text)
+    return None
 
-def get_data(project):
-    # Pick the latest release.
-    project_data = _get_project_data(project)
-    releases = project_data["releases"]
-    data = {}
 
-    for key, value in project_data["info"].items():
-        key = normalize(key)
-        if key in INFO_MAP:
-            key = INFO_MAP[key]
-        data[key] = value
+def get_data(project, metadata_only=None):
+    """Returns the data of the latest release of a project
 
-    release = data["version"]
+    With metadata_only, the PEP 658 metadata, or the metadata in a wheel, is
+    used instead of building the sdist, if there is any. The default is set
+    with set_metadata_only().
+    """
+    if metadata_only is None:
+        metadata_only = _metadata_only
+    index = get_index()
+    # Pick the latest release.
+    project_data = _get_project_data(project, index)
+    release = project_data["info"]["version"]
     logging.debug(f"Found {project} version {release}")
 
-    with xmlrpc.client.ServerProxy("https://pypi.org/pypi") as xmlrpc_client:
-        roles = xmlrpc_client.package_roles(project)
+    # The owners are fetched in a thread while the sdist is downloaded and
+    # built. The thread runs in a copy of the context, so it has the deadline.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        roles_future = executor.submit(contextvars.copy_context().run, index.roles, project)
+        data = get_release_data(project_data, release, index, metadata_only)
+        project_roles = roles_future.result()
+    if project_roles is not None:
+        data["_owners"] = owners(project_roles)
+    return data
+
+
+def owners(project_roles):
+    return [user for (role, user) in project_roles if role == "Owner"]
+
 
-    data["_owners"] = [user for (role, user) in roles if role == "Owner"]
+def get_release_data(project_data, release, index, metadata_only=False):
+    """Returns the data of one release of a project, from the project data of the index
 
-    # Get download_urls:
-    urls = releases[release]
+    The info in the project data is for the latest release, so for the other
+    releases only the name is taken from there, and the rest of the data
+    comes from the release files. The owners are not included.
+    """
+    info = project_data["info"]
+    if release == info["version"]:
+        data = {}
+        for key, value in info.items():
+            key = normalize(key)
+            if key in INFO_MAP:
+                key = INFO_MAP[key]
+            data[key] = value
+    else:
+        data = {"name": info["name"], "version": release}
+    return _add_distribution_data(data, project_data["releases"][release], index, metadata_only)
+
+
+def _add_distribution_data(data, urls, index, metadata_only=False):
     data["_pypi_downloads"] = bool(urls)
 
     # If there is a source download, download it, and get that data.
@@ -59,22 +472,28 @@ def get_data(project):
     data["_source_download"] = False
     data["_has_sdist"] = False
 
+    if metadata_only:
+        data["_has_sdist"] = any(download["packagetype"] == "sdist" for download in urls)
+        try:
+            mdata = _get_core_metadata(index, data["name"], urls)
+        except deadline.DeadlineExceeded as e:
+            data["_deadline_exceeded"] = e.phase
+            return data
+        if mdata is not None:
+            # Combine them, with the PyPI data winning:
+            mdata.update(data)
+            return mdata
+
     for download in urls:
         if download["packagetype"] == "sdist":
             # Found a source distribution. Download and analyze it.
             data["_has_sdist"] = True
-            tempdir = tempfile.gettempdir()
-            filename = download["url"].split("/")[-1]
-            tmp = os.path.join(tempdir, filename)
-            logging.debug(f"Downloading {filename} to verify distribution")
             try:
-                with open(tmp, "wb") as outfile:
-                    outfile.write(requests.get(download["url"]).content)
-                ddata = distributiondata.get_data(tmp)
-            except Exception:
-                # Clean up the file
-                os.unlink(tmp)
-                raise
+                ddata = index.distribution_data(download["url"], download.get("digests", {}).get("sha256"))
+            except deadline.DeadlineExceeded as e:
+                # We still have the data from the PyPI API, so rate that
+                data["_deadline_exceeded"] = e.phase
+                break
 
             # Combine them, with the PyPI data winning:
             ddata.update(data)
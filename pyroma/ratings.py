@@ -1,28 +1,37 @@
 # This is a collection of "tests" done on the package data. The resut of the
 # tests is used to give the package a rating.
 #
-# Each test has a couple of attributes. Both attributes are checked only after
-# the test is performed so the test can choose to set the attributes dependning
-# on the severity of the failure.
+# Each test returns a Result from its evaluate(data) method. The data is a
+# RatingData, which also has the classifiers, version and license parsed.
+# The result has these fields:
 #
-#     fatal:    If set to True, the failure of this test will cause the
-#               package to achieve the rating of 1, which is minimum
+#     passed:   True for pass, False for fail and None for not applicable
+#               (meaning it will not be counted).
 #     weight:   The relative importance of the test.
 #               If the test has fatal set to True this is ignored.
+#     fatal:    If set to True, the failure of this test will cause the
+#               package to achieve the rating of 1, which is minimum
+#     message:  What is wrong, if the test failed.
 #
-# Tests have two methods:
-#     test(data): Performs the test on the given data. Returns True for pass
-#                 False for fail and None for not applicable (meaning it will
-#                 not be counted).
+# The tests are shared by all ratings, so evaluate() must not change the
+# test, and rate() can be used from several threads at once. Simple tests can
+# instead have fatal and weight attributes and two methods:
+#     test(data): Returns True, False or None, like passed above.
+#     message():  Returns the message if the test failed.
+import copy
+import functools
+import importlib.util
 import io
 import re
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
 
-from docutils.core import publish_parts
-from docutils.utils import SystemMessage
+import docutils
 from trove_classifiers import classifiers as CLASSIFIERS
 from packaging.specifiers import InvalidSpecifier, SpecifierSet
 
+from pyroma import cache, deadline
+
 LEVELS = [
     "This cheese seems to contain no dairy products",
     "Vieux Bologne",
@@ -39,6 +48,16 @@ LEVELS = [
 
 SHORT_NAME_RE = re.compile(r"\(.*?\)")
 
+# The results of the ReST validation of this many descriptions are kept in
+# memory, and the results are also stored in the pyroma cache, if it's enabled,
+# up to REST_DISK_CACHE_SIZE bytes.
+REST_CACHE_SIZE = 256
+REST_DISK_CACHE_SIZE = 8 * 1024 * 1024
+
+_rest_results = OrderedDict()
+_rest_lock = threading.Lock()
+_check_manifest_lock = threading.Lock()
+
 
 def get_code_licenses():
     licenses = [each for each in list(CLASSIFIERS) if each.startswith("License")]
@@ -63,8 +82,66 @@ def get_code_licenses():
 CODE_LICENSES = get_code_licenses()
 
 
+@functools.lru_cache(maxsize=4096)
+def classifier_parts(classifier):
+    """Returns the stripped parts of a classifier
+
+    There are only so many classifiers, so when rating many projects, most
+    of them have been split before.
+    """
+    return tuple(part.strip() for part in classifier.split("::"))
+
+
+@functools.lru_cache(maxsize=4096)
+def version_schemes(version):
+    """Returns if the version complies with PEP 440, and if it complies with PEP 386"""
+    return PEP440_RE.search(version) is not None, PEP386_RE.search(version) is not None
+
+
+class RatingData(dict):
+    """The data of a project, with the values that several tests need parsed once
+
+    rate() makes one for each rating and passes it to the tests.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.classifiers = self.get("classifier") or []
+        # The classifiers split into their stripped parts, by top level category
+        tree = defaultdict(list)
+        self.license_classifiers = set()
+        for classifier in self.classifiers:
+            parts = classifier_parts(classifier)
+            tree[parts[0]].append(parts)
+            if parts[0] == "License":
+                self.license_classifiers.add(classifier)
+        self.classifier_tree = dict(tree)
+
+        self.pep440_version, self.pep386_version = version_schemes(str(self.get("version")))
+
+        license = self.get("license")
+        self.license = license.strip() if isinstance(license, str) else license
+
+
+# The outcome of a test. passed is True, False, or None if the test is not
+# applicable, and message is why it failed.
+Result = namedtuple("Result", "passed weight fatal message")
+
+
 class BaseTest:
     fatal = False
+    weight = 0
+
+    def evaluate(self, data):
+        """Returns the Result of the test
+
+        Tests whose weight and message don't depend on the data only need to
+        implement test() and message(). Tests that do must implement
+        evaluate() instead, and not change any attributes, so that the tests
+        can be used from several threads at once.
+        """
+        passed = self.test(data)
+        return Result(passed, self.weight, self.fatal, self.message() if passed is False else None)
 
 
 class FieldTest(BaseTest):
@@ -152,42 +229,31 @@ $""",
 
 class PEPVersion(BaseTest):
     weight = 50
-    pep386 = False
 
-    def test(self, data):
+    def evaluate(self, data):
         # Check that the version number complies to PEP-386:
-        version = data.get("version")
-        self.pep386 = False
-        if PEP386_RE.search(str(version)) is not None:
+        if data.pep386_version:
             # Matches the old PEP386
-            self.weight = 10
-            self.pep386 = True
-        match = PEP440_RE.search(str(version))
-        return match is not None
-
-    def message(self):
-        if self.pep386:
-            return "The package's version number complies only with PEP-386 and not PEP-440."
-        return "The package's version number does not comply with PEP-386 or PEP-440."
+            message = "The package's version number complies only with PEP-386 and not PEP-440."
+            return Result(data.pep440_version, 10, False, None if data.pep440_version else message)
+        if data.pep440_version:
+            return Result(True, self.weight, False, None)
+        return Result(
+            False, self.weight, False, "The package's version number does not comply with PEP-386 or PEP-440."
+        )
 
 
 class Summary(BaseTest):
     weight = 100
 
-    def test(self, data):
+    def evaluate(self, data):
         summary = data.get("summary")
         if not summary:
             # No description at all. That's fatal.
-            self.fatal = True
-            return False
-        self.fatal = False
-        return len(summary) > 10
-
-    def message(self):
-        if self.fatal:
-            return "The package had no Summary!"
-        else:
-            return "The package's Summary should be longer than 10 characters."
+            return Result(False, self.weight, True, "The package had no Summary!")
+        if len(summary) > 10:
+            return Result(True, self.weight, False, None)
+        return Result(False, self.weight, False, "The package's Summary should be longer than 10 characters.")
 
 
 class Description(BaseTest):
@@ -211,29 +277,23 @@ class Classifiers(FieldTest):
 class ClassifierVerification(BaseTest):
     weight = 20
 
-    def test(self, data):
-        self._incorrect = []
-        classifiers = data.get("classifier", [])
-        for classifier in classifiers:
+    def evaluate(self, data):
+        incorrect = []
+        for classifier in data.classifiers:
             if classifier not in CLASSIFIERS and not classifier.startswith("Private :: "):
-                self._incorrect.append(classifier)
-        if self._incorrect:
-            return False
-        return True
-
-    def message(self):
-        err = "\n".join(self._incorrect)
-        return "Some of your classifiers are not standard classifiers:\n" + err
+                incorrect.append(classifier)
+        if incorrect:
+            err = "\n".join(incorrect)
+            return Result(False, self.weight, False, "Some of your classifiers are not standard classifiers:\n" + err)
+        return Result(True, self.weight, False, None)
 
 
 class PythonClassifierVersion(BaseTest):
-    def test(self, data):
-        self._major_version_specified = False
+    def evaluate(self, data):
+        major_version_specified = False
 
-        classifiers = data.get("classifier", [])
-        for classifier in classifiers:
-            parts = [p.strip() for p in classifier.split("::")]
-            if parts[0] == "Programming Language" and parts[1] == "Python":
+        for parts in data.classifier_tree.get("Programming Language", []):
+            if parts[1] == "Python":
                 if len(parts) == 2:
                     # Specified Python, but no version.
                     continue
@@ -250,28 +310,23 @@ class PythonClassifierVersion(BaseTest):
                     # something like "2.7" or "3.3" but not just "2" or "3".
                     # This is a good specification, and we only need one.
                     # Set weight to 100 and finish.
-                    self.weight = 100
-                    return True
+                    return Result(True, 100, False, None)
 
                 # It's a valid int, meaning it specified "2" or "3".
-                self._major_version_specified = True
+                major_version_specified = True
 
         # There was some sort of failure:
-        if self._major_version_specified:
+        if major_version_specified:
             # Python 2 or 3 was specified but no more detail than that:
-            self.weight = 25
-        else:
-            # No Python version specified at all:
-            self.weight = 100
-        return False
-
-    def message(self):
-        if self._major_version_specified:
-            return (
+            return Result(
+                False,
+                25,
+                False,
                 "The classifiers should specify what minor versions of "
-                "Python you support as well as what major version."
+                "Python you support as well as what major version.",
             )
-        return "The classifiers should specify what Python versions you support."
+        # No Python version specified at all:
+        return Result(False, 100, False, "The classifiers should specify what Python versions you support.")
 
 
 class PythonRequiresVersion(BaseTest):
@@ -333,57 +388,35 @@ class Url(BaseTest):
 class Licensing(BaseTest):
     weight = 50
 
-    def test(self, data):
-        license = data.get("license")
+    def evaluate(self, data):
+        license = data.license
         license_expression = data.get("license-expression")
-        classifiers = data.get("classifier", [])
-        licenses = set()
-        for classifier in classifiers:
-            parts = [p.strip() for p in classifier.split("::")]
-            if parts[0] == "License":
-                # license classifiers exist
-                licenses.add(classifier)
+        licenses = data.license_classifiers
 
         if not license and not license_expression and not licenses:
-            self._message = "Your package does neither have a license field nor any license classifiers."
-            return False
-
-        if license and license_expression:
-            self._message = (
+            message = "Your package does neither have a license field nor any license classifiers."
+        elif license and license_expression:
+            message = (
                 "Specifying both a License and a License-Expression is ambiguous, deprecated, "
                 "and may be rejected by package indices."
             )
-            return False
-
-        if license_expression and licenses:
-            self._message = (
+        elif license_expression and licenses:
+            message = (
                 "Specifying both a License-Expression and license classifiers is ambiguous, deprecated, "
                 "and may be rejected by package indices."
             )
-            return False
-
-        if license in CODE_LICENSES:
-            if not CODE_LICENSES[license].intersection(licenses):
-                self._message = f"The license '{license}' specified is not listed in your classifiers."
-                return False
-
-        return True
-
-    def message(self):
-        return self._message
+        elif license in CODE_LICENSES and not CODE_LICENSES[license].intersection(licenses):
+            message = f"The license '{license}' specified is not listed in your classifiers."
+        else:
+            return Result(True, self.weight, False, None)
+        return Result(False, self.weight, False, message)
 
 
 class DevStatusClassifier(BaseTest):
     weight = 20
 
     def test(self, data):
-        classifiers = data.get("classifier", [])
-        for classifier in classifiers:
-            parts = [p.strip() for p in classifier.split("::")]
-            if parts[0] == "Development Status":
-                # license classifier exist
-                return True
-        return False
+        return "Development Status" in data.classifier_tree
 
     def message(self):
         return "Specifying a development status in the classifiers gives users a hint of how stable your software is."
@@ -392,102 +425,160 @@ class DevStatusClassifier(BaseTest):
 class SDist(BaseTest):
     weight = 100
 
-    def test(self, data):
+    def evaluate(self, data):
         if "_has_sdist" not in data:
             # We aren't checking on PyPI
-            self.weight = 0
-            return None
-        return data["_has_sdist"]
-
-    def message(self):
-        return (
+            return Result(None, 0, False, None)
+        if data["_has_sdist"]:
+            return Result(True, self.weight, False, None)
+        return Result(
+            False,
+            self.weight,
+            False,
             "You have no source distribution on the Cheeseshop. "
             "Uploading the source distribution to the Cheeseshop ensures "
-            "maximum availability of your package."
+            "maximum availability of your package.",
         )
 
 
+@functools.cache
+def _rest_settings():
+    """Returns the docutils settings for checking ReST, they are made once and copied for each check"""
+    from docutils.frontend import get_default_settings
+    from docutils.parsers.rst import Parser
+    from docutils.readers.standalone import Reader
+
+    settings = get_default_settings(Parser, Reader)
+    # Like publish_parts(), so that errors above the halt level are raised
+    settings.traceback = True
+    return settings
+
+
+def _check_rest(source):
+    # docutils is slow to import, and only needed if the result isn't cached
+    from docutils.parsers.rst import Parser
+    from docutils.readers.standalone import Reader
+    from docutils.utils import SystemMessage, new_document
+
+    stream = io.StringIO()
+    settings = copy.copy(_rest_settings())
+    settings.warning_stream = stream
+
+    # Only the text is parsed, and the transforms that check the references
+    # and such are applied, the document is not rendered.
+    parser = Parser()
+    document = new_document("<string>", settings)
+    try:
+        parser.parse(source, document)
+        document.transformer.populate_from_components((Reader(parser), parser))
+        document.transformer.apply_transforms()
+    except SystemMessage:
+        # The error is also written to the warning stream
+        pass
+    errors = stream.getvalue().strip()
+    if not errors:
+        return None
+    return "\n" + errors
+
+
+def check_rest(source):
+    """Returns the errors in a ReST text, or None if it's valid
+
+    The results are cached on the hash of the text and the version of
+    docutils, so validating an unchanged description again is fast.
+    """
+    key = cache.make_key(source, docutils.__version__, cache.pyroma_version())
+    with _rest_lock:
+        if key in _rest_results:
+            _rest_results.move_to_end(key)
+            return _rest_results[key]
+
+    rest_cache = cache.get_cache("rest", REST_DISK_CACHE_SIZE)
+    entry = rest_cache.get(key)
+    if entry is not None:
+        errors = entry["errors"]
+    else:
+        errors = _check_rest(source)
+        rest_cache.set(key, {"errors": errors})
+
+    with _rest_lock:
+        _rest_results[key] = errors
+        while len(_rest_results) > REST_CACHE_SIZE:
+            _rest_results.popitem(last=False)
+    return errors
+
+
+def clear_rest_cache():
+    """Forgets the ReST validation results kept in memory"""
+    with _rest_lock:
+        _rest_results.clear()
+
+
 class ValidREST(BaseTest):
     weight = 50
 
-    def test(self, data):
+    def evaluate(self, data):
         content_type = data.get("description-content-type", None)
         if content_type in ("text/plain", "text/markdown"):
             # These can't fail. Markdown will just assume everything
             # it doesn't understand is plain text.
-            return True
+            return Result(True, self.weight, False, None)
 
         # This should be ReStructuredText
         source = data.get("description", "")
-        stream = io.StringIO()
-        settings = {"warning_stream": stream}
-
-        try:
-            publish_parts(source=source, writer="html4css1", settings_overrides=settings)
-        except SystemMessage as e:
-            self._message = e.args[0]
-        errors = stream.getvalue().strip()
-        if not errors:
-            return True
-
-        self._message = "\n" + errors
-        return False
-
-    def message(self):
-        return "Your Description is not valid ReST: " + self._message
+        if not isinstance(source, str):
+            source = ""
+        errors = check_rest(source)
+        if errors is None:
+            return Result(True, self.weight, False, None)
+        return Result(False, self.weight, False, "Your Description is not valid ReST: " + errors)
 
 
 class BusFactor(BaseTest):
-    def test(self, data):
+    def evaluate(self, data):
         if "_owners" not in data:
-            self.weight = 0
-            return None
+            return Result(None, 0, False, None)
 
+        message = "You should have three or more owners of the project on PyPI."
         if len(data.get("_owners", [])) == 1:
-            self.weight = 100
-            return False
+            return Result(False, 100, False, message)
 
         if len(data.get("_owners", [])) == 2:
-            self.weight = 50
-            return False
+            return Result(False, 50, False, message)
 
         # Three or more, that's good.
-        self.weight = 100
-        return True
-
-    def message(self):
-        return "You should have three or more owners of the project on PyPI."
+        return Result(True, 100, False, None)
 
 
 class MissingBuildSystem(BaseTest):
-    def test(self, data):
+    def evaluate(self, data):
         if "_missing_build_system" in data:
             # These sort of "negative only/deprecation" ratings only give you negative weight
-            self.weight = 400
-            return False
-
-    def message(self):
-        return (
-            "You seem to neither have a setup.py, nor a pyproject.toml, only setup.cfg.\n"
-            "This makes it unclear how your project should be built, and some packaging tools may fail."
-        )
+            return Result(
+                False,
+                400,
+                False,
+                "You seem to neither have a setup.py, nor a pyproject.toml, only setup.cfg.\n"
+                "This makes it unclear how your project should be built, and some packaging tools may fail.",
+            )
+        return Result(None, 0, False, None)
 
 
 class MissingPyProjectToml(BaseTest):
-    def test(self, data):
+    def evaluate(self, data):
         if "_missing_build_system" in data or "_missing_pyproject_toml" in data:
             # These sort of "negative only/deprecation" ratings only give you negative weight
-            self.weight = 100
-            return False
-
-    def message(self):
-        return (
-            "Your project does not have a pyproject.toml file, which is highly recommended.\n"
-            "You probably want to create one with the following configuration:\n\n"
-            "    [build-system]\n"
-            '    requires = ["setuptools>=42"]\n'
-            '    build-backend = "setuptools.build_meta"\n'
-        )
+            return Result(
+                False,
+                100,
+                False,
+                "Your project does not have a pyproject.toml file, which is highly recommended.\n"
+                "You probably want to create one with the following configuration:\n\n"
+                "    [build-system]\n"
+                '    requires = ["setuptools>=42"]\n'
+                '    build-backend = "setuptools.build_meta"\n',
+            )
+        return Result(None, 0, False, None)
 
 
 ALL_TESTS = [
@@ -514,34 +605,33 @@ ALL_TESTS = [
     DevStatusClassifier(),
 ]
 
-try:
-    import check_manifest
-
-    class CheckManifest(BaseTest):
-        weight = 0
 
-        def test(self, data):
-            if "_path" not in data:
-                return None
+class CheckManifest(BaseTest):
+    weight = 200
 
-            self.weight = 200
-            try:
-                return check_manifest.check_manifest(data["_path"])
-            except check_manifest.Failure:
-                # Most likely this means check-manifest didn't find any
-                # package configuration, which is the same failure as
-                # MissingBuildSystem, so this is double errors, but
-                # it does mean your setup is completely broken, so...
-                return False
+    def evaluate(self, data):
+        if "_path" not in data:
+            return Result(None, 0, False, None)
 
-        def message(self):
-            return "Check-manifest returned errors"
+        # check-manifest imports setuptools, so it's only imported when it's used
+        import check_manifest
 
+        try:
+            # check-manifest changes the working directory, so only one can run at a time
+            with _check_manifest_lock:
+                passed = check_manifest.check_manifest(data["_path"])
+        except check_manifest.Failure:
+            # Most likely this means check-manifest didn't find any
+            # package configuration, which is the same failure as
+            # MissingBuildSystem, so this is double errors, but
+            # it does mean your setup is completely broken, so...
+            passed = False
+        return Result(passed, self.weight, False, None if passed else "Check-manifest returned errors")
+
+
+if importlib.util.find_spec("check_manifest") is not None:
     ALL_TESTS.append(CheckManifest())
 
-except ImportError:
-    pass
-
 
 def rate(data, skip_tests=None):
     if len([key for key in data if not key.startswith("_")]) == 0:
@@ -559,30 +649,46 @@ def rate(data, skip_tests=None):
                 ],
             )
 
+        if "_deadline_exceeded" in data:
+            return (0, [f"Pyroma ran out of time while {data['_deadline_exceeded']}, so nothing could be rated."])
+
     if skip_tests is None:
         skip_tests = []
 
+    # The values that several tests need are parsed once
+    data = RatingData(data)
     fails = []
+    if "_deadline_exceeded" in data:
+        fails.append(f"Pyroma ran out of time while {data['_deadline_exceeded']}, so the rating may be incomplete.")
+    not_evaluated = []
     good = 0
     bad = 0
     fatality = False
     for test in ALL_TESTS:
         if test.__class__.__name__ in skip_tests:
             continue
-        res = test.test(data)
-        if res is False:
-            fails.append(test.message())
-            if test.fatal:
+        if deadline.expired():
+            not_evaluated.append(test.__class__.__name__)
+            continue
+        result = test.evaluate(data)
+        if result.passed is False:
+            fails.append(result.message)
+            if result.fatal:
                 fatality = True
             else:
-                bad += test.weight
-        elif res is True:
-            if not test.fatal:
-                good += test.weight
-    # If res is None, it's ignored.
+                bad += result.weight
+        elif result.passed is True:
+            if not result.fatal:
+                good += result.weight
+    # If passed is None, it's ignored.
+    if not_evaluated:
+        fails.append("Pyroma ran out of time before these tests were evaluated: " + ", ".join(not_evaluated))
     if fatality:
         # A fatal test failed. That means we give a 0 rating:
         return 0, fails
+    if good + bad == 0:
+        # Nothing was evaluated
+        return 0, fails
     # Multiply good by 9, and add 1 to get a rating between
     # 1: All non-fatal tests failed.
     # 10: All tests succeeded.
@@ -0,0 +1,129 @@
+"""
+The roles of the users of projects on PyPI, for the BusFactor test.
+
+PyPI only has the roles in its XML-RPC API, which is slow and rate limited.
+So the roles of many projects are fetched in one system.multicall request,
+and are cached, in memory and in the pyroma cache, for TTL seconds. Use
+prefetch() to fetch the roles of many projects at once before rating them.
+
+If PyPI can't be reached, older cached roles are used, and if there are
+none, the roles are unknown, and BusFactor is skipped.
+"""
+
+import logging
+import re
+import threading
+import time
+import xmlrpc.client
+
+from pyroma import cache, deadline
+
+XMLRPC_URL = "https://pypi.org/pypi"
+# How long the roles are cached, in seconds
+TTL = 24 * 60 * 60
+# How many projects are looked up in one request
+BATCH_SIZE = 50
+
+_memory = {}
+_lock = threading.Lock()
+
+
+class TimeoutTransport(xmlrpc.client.SafeTransport):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+def _key(project):
+    return re.sub(r"[-_.]+", "-", project).lower()
+
+
+def _cached(project):
+    """Returns the cached {"time": ..., "roles": ...} entry for a project, or None"""
+    key = _key(project)
+    entry = _memory.get(key)
+    if entry is None:
+        entry = cache.get_cache("roles").get(cache.make_key(key))
+        if entry is not None:
+            _memory[key] = entry
+    return entry
+
+
+def _store(project, roles):
+    key = _key(project)
+    entry = {"time": time.time(), "roles": roles}
+    _memory[key] = entry
+    cache.get_cache("roles").set(cache.make_key(key), entry)
+
+
+def _fetch(projects):
+    """Fetches the roles of the projects from PyPI, in batches of BATCH_SIZE"""
+    timeout = deadline.remaining()
+    kw = {} if timeout is None else {"transport": TimeoutTransport(timeout)}
+    results = {}
+    try:
+        with xmlrpc.client.ServerProxy(XMLRPC_URL, **kw) as xmlrpc_client:
+            for start in range(0, len(projects), BATCH_SIZE):
+                end = start + BATCH_SIZE
+                batch = projects[start:end]
+                multicall = xmlrpc.client.MultiCall(xmlrpc_client)
+                for project in batch:
+                    multicall.package_roles(project)
+                # Iterating over the results raises a Fault for failed calls,
+                # so they are fetched by index.
+                result = multicall()
+                for index, project in enumerate(batch):
+                    try:
+                        results[project] = [list(role) for role in result[index]]
+                    except xmlrpc.client.Fault as e:
+                        logging.debug(f"Could not get the roles of {project}: {e.faultString}")
+    except TimeoutError:
+        if timeout is None:
+            raise
+        raise deadline.DeadlineExceeded("fetching the owners from PyPI")
+    return results
+
+
+def prefetch(projects):
+    """Fetches the roles of the projects that aren't cached, with as few requests as possible"""
+    with _lock:
+        now = time.time()
+        missing = []
+        for project in dict.fromkeys(projects):
+            entry = _cached(project)
+            if entry is None or now - entry["time"] > TTL:
+                missing.append(project)
+        if not missing:
+            return
+
+        try:
+            results = _fetch(missing)
+        except (OSError, xmlrpc.client.Error) as e:
+            # The stale roles in the cache are used, if there are any
+            logging.debug(f"Could not fetch the owners from PyPI: {e}")
+            return
+        for project, roles in results.items():
+            _store(project, roles)
+
+
+def get_roles(project):
+    """Returns the roles of a project as a list of [role, user], or None if they are unknown"""
+    try:
+        prefetch([project])
+    except deadline.DeadlineExceeded:
+        if _cached(project) is None:
+            raise
+    entry = _cached(project)
+    if entry is None:
+        return None
+    return entry["roles"]
+
+
+def clear_memory():
+    """Forgets the roles cached in memory"""
+    _memory.clear()
@@ -1,15 +1,46 @@
+import concurrent.futures
+import functools
+import hashlib
+import http.server
 import io
 
 import json
 import os
+import shutil
+import socketserver
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
 import unittest
 
 import unittest.mock
 from pathlib import Path
 
+import build.util
+from packaging.version import Version
+
 from xmlrpc import client as xmlrpclib
 
-from pyroma import projectdata, distributiondata, pypidata
+from pyroma import (
+    backendpool,
+    batch,
+    buildenv,
+    cache,
+    deadline,
+    deptree,
+    history,
+    httpcache,
+    projectdata,
+    distributiondata,
+    pypidata,
+    ratings,
+    roles,
+)
+import pyroma
 from pyroma.ratings import rate
 
 TESTDATA_DIR = Path(__file__).parent / "testdata"
@@ -66,6 +97,7 @@ class ProxyStub:
         self.args = data["args"]
         self.kw = data["kw"]
         self._data = data["data"]
+        self.multicalls = []
 
         if developmode:
             self._real = real_class(*self.args, **self.kw)
@@ -83,6 +115,16 @@ class ProxyStub:
 
         return _proxy_method
 
+    def _multicall(self, calls):
+        self.multicalls.append(calls)
+        results = []
+        for call in calls:
+            try:
+                results.append([self._data[call["methodName"]][tuple(call["params"])]])
+            except KeyError:
+                results.append({"faultCode": 1, "faultString": f"Unknown {call['methodName']}{call['params']}"})
+        return results
+
     def _make_unknown_proxy(self, name):
         def _proxy_method(*args, **kw):
             if self._real is None:
@@ -100,6 +142,8 @@ class ProxyStub:
     def __getattr__(self, attr):
         if attr in ("_data", "_make_proxy", "_make_unknown_proxy"):
             raise AttributeError("Break infinite recursion chain")
+        if attr == "system":
+            return types.SimpleNamespace(multicall=self._multicall)
         if attr in self._data:
             return self._make_proxy(attr)
         return self._make_unknown_proxy(attr)
@@ -127,6 +171,66 @@ class RatingsTest(unittest.TestCase):
         # Should have a perfect score
         self.assertEqual(rating, (10, []))
 
+    def test_rating_data(self):
+        data = ratings.RatingData(
+            {
+                "version": "1.0",
+                "license": " MIT ",
+                "classifier": [
+                    "Development Status :: 5 - Production/Stable",
+                    "License :: OSI Approved :: MIT License",
+                    "Programming Language :: Python :: 3",
+                    "Programming Language :: Python :: 3.12",
+                ],
+            }
+        )
+        self.assertEqual(
+            data.classifier_tree,
+            {
+                "Development Status": [("Development Status", "5 - Production/Stable")],
+                "License": [("License", "OSI Approved", "MIT License")],
+                "Programming Language": [
+                    ("Programming Language", "Python", "3"),
+                    ("Programming Language", "Python", "3.12"),
+                ],
+            },
+        )
+        self.assertEqual(data.license_classifiers, {"License :: OSI Approved :: MIT License"})
+        self.assertEqual(data.license, "MIT")
+        self.assertTrue(data.pep440_version)
+        self.assertTrue(data.pep386_version)
+        # It's still the data
+        self.assertEqual(data["license"], " MIT ")
+
+        data = ratings.RatingData({"version": "1.0.dev4+local"})
+        self.assertEqual(data.classifier_tree, {})
+        self.assertTrue(data.pep440_version)
+        self.assertFalse(data.pep386_version)
+
+    def test_concurrent_ratings(self):
+        variants = [
+            COMPLETE,
+            dict(COMPLETE, version="1.0c1"),
+            dict(COMPLETE, version="not a version"),
+            dict(COMPLETE, summary=""),
+            dict(COMPLETE, summary="Short"),
+            dict(COMPLETE, classifier=["Programming Language :: Python :: 3", "Not :: A :: Classifier"]),
+            dict(COMPLETE, license="MIT", classifier=[]),
+            dict(COMPLETE, _owners=["regebro"], _has_sdist=False),
+            dict(COMPLETE, _owners=["regebro", "ivan"], description="Title\n===\n\n`broken\n"),
+            dict(COMPLETE, _missing_build_system=True),
+        ]
+        expected = [rate(data) for data in variants]
+        # The ratings don't depend on what was rated before
+        self.assertEqual([rate(data) for data in reversed(variants)], expected[::-1])
+        test_state = [dict(vars(test)) for test in ratings.ALL_TESTS]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(rate, variants * 200))
+        self.assertEqual(results, expected * 200)
+        # The tests were not changed
+        self.assertEqual([dict(vars(test)) for test in ratings.ALL_TESTS], test_state)
+
     def test_setup_config(self):
         rating = self._get_file_rating("setup_config")
         self.assertEqual(
@@ -304,18 +408,24 @@ class RatingsTest(unittest.TestCase):
 class PyPITest(unittest.TestCase):
     maxDiff = None
 
+    def setUp(self):
+        roles.clear_memory()
+
     @unittest.mock.patch("xmlrpc.client.ServerProxy", proxystub)
     @unittest.mock.patch("pyroma.pypidata._get_project_data")
-    @unittest.mock.patch("requests.get")
-    def test_complete(self, requestmock, projectdatamock):
+    @unittest.mock.patch("pyroma.pypidata.download_file")
+    def test_complete(self, downloadmock, projectdatamock):
         datafile = TESTDATA_DIR / "jsondata" / "complete.json"
         with open(datafile, encoding="UTF-8") as file:
             projectdatamock.return_value = json.load(file)
 
         srcfile = TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz"
-        with open(srcfile, "rb") as file:
-            requestmock.return_value = unittest.mock.Mock()
-            requestmock.return_value.content = file.read()
+
+        def download_file(url, path, sha256=None):
+            shutil.copy(srcfile, path)
+            return sha256
+
+        downloadmock.side_effect = download_file
 
         proxystub.set_debug_context("completedata.py", xmlrpclib.ServerProxy, False)
         data = pypidata.get_data("complete")
@@ -323,6 +433,41 @@ class PyPITest(unittest.TestCase):
 
         self.assertEqual(rating, (10, []))
 
+    @unittest.mock.patch("pyroma.pypidata._get_project_data")
+    def test_concurrent(self, projectdatamock):
+        datafile = TESTDATA_DIR / "jsondata" / "complete.json"
+        with open(datafile, encoding="UTF-8") as file:
+            projectdatamock.return_value = json.load(file)
+        remaining = []
+        # Both must be waiting at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=10)
+        passed = []
+
+        def get_roles(project):
+            remaining.append(deadline.remaining())
+            barrier.wait()
+            passed.append("roles")
+            return [["Owner", "regebro"]]
+
+        def get_distribution_data(url, sha256):
+            barrier.wait()
+            passed.append("sdist")
+            return {"name": "complete", "description": "From the sdist"}
+
+        with unittest.mock.patch("pyroma.pypidata._get_roles", get_roles):
+            with unittest.mock.patch("pyroma.pypidata._get_distribution_data", get_distribution_data):
+                with deadline.limit(60):
+                    data = pypidata.get_data("complete")
+
+        # The owners and the sdist were fetched at the same time
+        self.assertEqual(sorted(passed), ["roles", "sdist"])
+        self.assertEqual(data["_owners"], ["regebro"])
+        self.assertTrue(data["_source_download"])
+        # The PyPI data wins over the sdist data
+        self.assertNotEqual(data["description"], "From the sdist")
+        # The deadline applies in the thread too
+        self.assertIsNotNone(remaining[0])
+
 
 class ProjectDataTest(unittest.TestCase):
     maxDiff = None
@@ -335,6 +480,1022 @@ class ProjectDataTest(unittest.TestCase):
         self.assertEqual(data, COMPLETE)
 
 
+class StaticMetadataTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_pep621_skips_backend(self):
+        directory = TESTDATA_DIR / "pep621"
+        with unittest.mock.patch("pyroma.projectdata.build_metadata") as build_mock:
+            data = projectdata.get_data(directory)
+            self.assertFalse(build_mock.called)
+        self.assertEqual(data["name"], "pyroma_pep621_test_pkg")
+        self.assertEqual(data["author-email"], "Lennart Regebro <regebro@gmail.com>")
+        self.assertEqual(data["project-url"], "Homepage, https://github.com/regebro/pyroma")
+
+    def test_pep621_consistency(self):
+        self.assertEqual(projectdata.compare_static_data(TESTDATA_DIR / "pep621"), [])
+
+    def test_dynamic(self):
+        # setup.py based projects need the backend
+        self.assertIsNone(projectdata.get_static_data(TESTDATA_DIR / "complete"))
+
+        pyproject = {"project": {"name": "foo", "version": "1.0", "dynamic": ["scripts"]}}
+        self.assertEqual(projectdata.static_metadata(pyproject, None), {"name": "foo", "version": "1.0"})
+        pyproject["project"]["dynamic"].append("description")
+        self.assertIsNone(projectdata.static_metadata(pyproject, None))
+
+        # The dependencies are in the requires-dist metadata
+        pyproject = {"project": {"name": "foo", "version": "1.0", "dynamic": ["dependencies"]}}
+        self.assertIsNone(projectdata.static_metadata(pyproject, None))
+        pyproject = {"project": {"name": "foo", "version": "1.0", "dynamic": ["optional-dependencies"]}}
+        self.assertIsNone(projectdata.static_metadata(pyproject, None))
+
+    def test_dynamic_dependencies(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            with open(os.path.join(tempdir, "pyproject.toml"), "w", encoding="UTF-8") as pyproject:
+                pyproject.write(
+                    '[build-system]\nrequires = ["setuptools>=61"]\nbuild-backend = "setuptools.build_meta"\n\n'
+                    '[project]\nname = "foo"\nversion = "1.0"\ndynamic = ["dependencies"]\n\n'
+                    "[tool.setuptools]\npy-modules = []\n\n"
+                    '[tool.setuptools.dynamic]\ndependencies = {file = ["requirements.txt"]}\n'
+                )
+            with open(os.path.join(tempdir, "requirements.txt"), "w", encoding="UTF-8") as requirements:
+                requirements.write("requests>=2\n")
+            data = projectdata.get_data(tempdir)
+        self.assertEqual(data["requires-dist"], "requests>=2")
+
+    def test_mapping(self):
+        pyproject = {
+            "project": {
+                "name": "foo",
+                "version": "01.0",
+                "readme": {"text": "Foo\n===\n", "content-type": "text/x-rst"},
+                "license": {"text": "MIT"},
+                "authors": [{"name": "Foo Bar"}, {"email": "foo@example.com"}],
+                "maintainers": [{"name": "Bar", "email": "bar@example.com"}],
+                "dependencies": ["bar>=1"],
+                "optional-dependencies": {"test": ["pytest; python_version >= '3.10'"]},
+            }
+        }
+        self.assertEqual(
+            projectdata.static_metadata(pyproject, None),
+            {
+                "name": "foo",
+                "version": "1.0",
+                "description": "Foo\n===\n",
+                "description-content-type": "text/x-rst",
+                "license": "MIT",
+                "author": "Foo Bar",
+                "author-email": "foo@example.com",
+                "maintainer-email": "Bar <bar@example.com>",
+                "requires-dist": ["bar>=1", 'pytest; python_version >= "3.10" and extra == "test"'],
+                "provides-extra": "test",
+            },
+        )
+
+
+@unittest.skipUnless(backendpool.is_supported(), "The backend pool needs os.fork()")
+class BackendPoolTest(unittest.TestCase):
+    maxDiff = None
+
+    def tearDown(self):
+        backendpool.disable()
+
+    def _workers(self):
+        return [worker for workers in backendpool._pool._idle.values() for worker in workers]
+
+    def test_reuse(self):
+        backendpool.enable()
+        directory = TESTDATA_DIR / "complete"
+        for i in range(2):
+            data = projectdata.get_data(directory)
+            del data["_path"]
+            self.assertEqual(data, COMPLETE)
+
+        workers = self._workers()
+        self.assertEqual(len(workers), 1)
+        # One call to prepare_metadata_for_build_wheel per build
+        self.assertEqual(workers[0].tasks, 2)
+
+    def test_recycle(self):
+        backendpool.enable(max_tasks=1)
+        projectdata.get_data(TESTDATA_DIR / "complete")
+        self.assertEqual(self._workers(), [])
+
+    def test_crash(self):
+        backendpool.enable()
+        directory = TESTDATA_DIR / "complete"
+        projectdata.get_data(directory)
+        worker = self._workers()[0]
+        worker.process.kill()
+        worker.process.wait()
+
+        data = projectdata.get_data(directory)
+        self.assertEqual(data["name"], "complete")
+        self.assertNotIn(worker, self._workers())
+
+    def test_failing_hook(self):
+        backendpool.enable()
+        with tempfile.TemporaryDirectory() as tempdir:
+            script = os.path.join(tempdir, "hook.py")
+            with open(script, "w", encoding="UTF-8") as hookfile:
+                hookfile.write("import sys\nprint('Broken')\nsys.exit(3)\n")
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                backendpool.get_runner()([sys.executable, script], cwd=tempdir)
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, b"Broken\n")
+
+    def test_deadline(self):
+        backendpool.enable()
+        with tempfile.TemporaryDirectory() as tempdir:
+            script = os.path.join(tempdir, "hook.py")
+            with open(script, "w", encoding="UTF-8") as hookfile:
+                hookfile.write("import time\ntime.sleep(30)\n")
+            with self.assertRaises(deadline.DeadlineExceeded), deadline.limit(0.5):
+                backendpool.get_runner()([sys.executable, script], cwd=tempdir)
+        # The worker was killed
+        self.assertEqual(self._workers(), [])
+
+
+IN_TREE_BACKEND = """
+import os
+
+def prepare_metadata_for_build_wheel(metadata_directory, config_settings=None):
+    distinfo = os.path.join(metadata_directory, "intree-1.0.dist-info")
+    os.mkdir(distinfo)
+    with open(os.path.join(distinfo, "METADATA"), "w") as metadata:
+        metadata.write("Metadata-Version: 2.1\\nName: intree\\nVersion: 1.0\\n")
+    return "intree-1.0.dist-info"
+"""
+
+
+class BuildEnvTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        cache.enable(os.path.join(self.tempdir, "cache"))
+
+    def tearDown(self):
+        cache.disable()
+        buildenv.set_wheelhouse(None)
+        shutil.rmtree(self.tempdir)
+
+    def test_key(self):
+        self.assertEqual(
+            buildenv.environment_key(["setuptools >= 42", "wheel"]),
+            buildenv.environment_key(["wheel", "setuptools>=42"]),
+        )
+        self.assertNotEqual(
+            buildenv.environment_key(["setuptools>=42"]),
+            buildenv.environment_key(["setuptools>=61"]),
+        )
+
+    def test_wheelhouse(self):
+        buildenv.set_wheelhouse(self.tempdir)
+        env = buildenv.CachedIsolatedEnv(os.path.join(self.tempdir, "env"))
+        os.mkdir(env.path)
+        with unittest.mock.patch("subprocess.run") as runmock:
+            runmock.return_value.returncode = 0
+            env.install(["flit_core>=3.4,<4"])
+            cmd = runmock.call_args[0][0]
+        self.assertEqual(cmd[-3:], ["--find-links", self.tempdir, "flit_core<4,>=3.4"])
+        self.assertIn("--no-index", cmd)
+
+        # Installed requirements are not installed again
+        with unittest.mock.patch("subprocess.run") as runmock:
+            env.install(["flit_core >=3.4, <4"])
+            self.assertFalse(runmock.called)
+
+    def test_reuse(self):
+        # A project with an in-tree backend and no requirements, so it works offline
+        projectdir = os.path.join(self.tempdir, "intree")
+        os.mkdir(projectdir)
+        with open(os.path.join(projectdir, "pyproject.toml"), "w", encoding="UTF-8") as pyproject:
+            pyproject.write('[build-system]\nrequires = []\nbuild-backend = "backend"\nbackend-path = ["."]\n')
+        with open(os.path.join(projectdir, "backend.py"), "w", encoding="UTF-8") as backend:
+            backend.write(IN_TREE_BACKEND)
+
+        create = buildenv.CachedIsolatedEnv.create
+        with unittest.mock.patch.object(buildenv.CachedIsolatedEnv, "create", autospec=True) as createmock:
+            createmock.side_effect = create
+            for i in range(2):
+                data = projectdata.build_metadata(projectdir, isolated=True)
+                self.assertEqual(data["name"], "intree")
+            self.assertEqual(createmock.call_count, 1)
+
+        self.assertEqual(len(os.listdir(cache.get_directory("buildenvs"))), 2)  # The env and its lock file
+
+    def test_dynamic_requirements(self):
+        projectdir = os.path.join(self.tempdir, "intree")
+        os.mkdir(projectdir)
+        with open(os.path.join(projectdir, "pyproject.toml"), "w", encoding="UTF-8") as pyproject:
+            pyproject.write('[build-system]\nrequires = []\nbuild-backend = "backend"\nbackend-path = ["."]\n')
+        with open(os.path.join(projectdir, "backend.py"), "w", encoding="UTF-8") as backend:
+            backend.write(IN_TREE_BACKEND)
+            backend.write('\ndef get_requires_for_build_wheel(config_settings=None):\n    return ["cython<3"]\n')
+
+        def install(env, requirements):
+            # Records the requirements without installing them, so no network is needed
+            env._write_record(env.installed() | set(buildenv.normalize_requirements(requirements)))
+
+        with unittest.mock.patch.object(buildenv.CachedIsolatedEnv, "install", autospec=True) as installmock:
+            installmock.side_effect = install
+            data = projectdata.build_metadata(projectdir, isolated=True)
+        self.assertEqual(data["name"], "intree")
+
+        # The requirements of the backend are installed in an environment of their own
+        envs_dir = cache.get_directory("buildenvs")
+        base = buildenv.CachedIsolatedEnv(os.path.join(envs_dir, buildenv.environment_key([])))
+        extended = buildenv.CachedIsolatedEnv(os.path.join(envs_dir, buildenv.environment_key(["cython<3"])))
+        self.assertEqual(base.installed(), set())
+        self.assertEqual(extended.installed(), {"cython<3"})
+
+    @unittest.skipIf(buildenv.fcntl is None, "No file locks")
+    def test_lock_deadline(self):
+        path = os.path.join(self.tempdir, "env.lock")
+        with buildenv._locked(path):
+            # Another process creating the environment blocks the use of it, until the deadline
+            with deadline.limit(0.3):
+                with self.assertRaises(deadline.DeadlineExceeded):
+                    with buildenv._locked(path, shared=True):
+                        pass
+        with buildenv._locked(path, shared=True):
+            with buildenv._locked(path, shared=True):
+                pass
+
+
+class DeadlineTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_rating(self):
+        with deadline.limit(0):
+            rating = rate(COMPLETE)
+        self.assertEqual(rating[0], 0)
+        self.assertTrue(rating[1][0].startswith("Pyroma ran out of time before these tests were evaluated: "))
+        self.assertIn("ValidREST", rating[1][0])
+
+    def test_hung_build(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            with open(os.path.join(tempdir, "setup.py"), "w", encoding="UTF-8") as setup:
+                setup.write("import time\ntime.sleep(30)\n")
+            with unittest.mock.patch("pyroma.ratings.rate", wraps=rate) as ratemock:
+                rating = pyroma.run("directory", tempdir, quiet=True, timeout=1)
+
+        self.assertEqual(rating, 0)
+        data = ratemock.call_args[0][0]
+        self.assertEqual(
+            rate(data), (0, ["Pyroma ran out of time while running the build backend, so nothing could be rated."])
+        )
+
+    @unittest.mock.patch("xmlrpc.client.ServerProxy", proxystub)
+    @unittest.mock.patch("pyroma.pypidata._get_project_data")
+    @unittest.mock.patch("pyroma.pypidata.download_file")
+    def test_partial_pypi(self, downloadmock, projectdatamock):
+        datafile = TESTDATA_DIR / "jsondata" / "complete.json"
+        with open(datafile, encoding="UTF-8") as file:
+            projectdatamock.return_value = json.load(file)
+        downloadmock.return_value = "0" * 64
+
+        proxystub.set_debug_context("completedata.py", xmlrpclib.ServerProxy, False)
+        with unittest.mock.patch("pyroma.distributiondata.get_data") as distmock:
+            distmock.side_effect = deadline.DeadlineExceeded("extracting the distribution")
+            data = pypidata.get_data("complete")
+
+        # The data from the PyPI API is still rated
+        self.assertEqual(data["name"], "complete")
+        self.assertFalse(data["_source_download"])
+        rating = rate(data)
+        self.assertEqual(
+            rating[1][0], "Pyroma ran out of time while extracting the distribution, so the rating may be incomplete."
+        )
+
+    @unittest.skipUnless(batch._mp_context().get_start_method() == "fork", "The workers must be forked")
+    def test_batch_budget(self):
+        def get_rating(mode, argument, skip_tests=None):
+            return {"name": repr(deadline.end())}, (10, [])
+
+        projects = [("directory", str(TESTDATA_DIR / name)) for name in ("complete", "minimal", "lacking")]
+        with unittest.mock.patch("pyroma.get_rating", get_rating):
+            start = time.monotonic()
+            results = batch.run_batch(projects, jobs=2, timeout=60)
+        # All the projects share one deadline
+        ends = {float(name) for argument, name, rating, problems, error in results}
+        self.assertEqual(len(ends), 1)
+        self.assertAlmostEqual(ends.pop(), start + 60, delta=5)
+
+    def test_tree_budget(self):
+        ends = []
+
+        def get_data(project, metadata_only=None):
+            ends.append(deadline.end())
+            data = COMPLETE.copy()
+            data["name"] = project
+            data["requires-dist"] = {"top": ["middle"], "middle": ["bottom"]}.get(project, [])
+            return data
+
+        with unittest.mock.patch("pyroma.pypidata.get_data", get_data), unittest.mock.patch("pyroma.roles.prefetch"):
+            root, nodes = deptree.rate_tree("pypi", "top", jobs=2, timeout=60)
+        self.assertEqual(sorted(nodes), ["bottom", "middle", "top"])
+        self.assertEqual(len(ends), 3)
+        self.assertEqual(len(set(ends)), 1)
+        self.assertIsNotNone(ends[0])
+
+
+class RolesTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        roles.clear_memory()
+        proxystub.set_debug_context("completedata.py", xmlrpclib.ServerProxy, False)
+        self.tempdir = tempfile.mkdtemp()
+        cache.enable(self.tempdir)
+
+    def tearDown(self):
+        roles.clear_memory()
+        cache.disable()
+        shutil.rmtree(self.tempdir)
+
+    @unittest.mock.patch("xmlrpc.client.ServerProxy", proxystub)
+    def test_multicall(self):
+        roles.prefetch(["complete", "unknown", "complete"])
+        self.assertEqual(len(proxystub.multicalls), 1)
+        self.assertEqual([call["params"] for call in proxystub.multicalls[0]], [("complete",), ("unknown",)])
+
+        # The roles are now cached
+        self.assertEqual(roles.get_roles("Complete"), [["Owner", "someone"], ["Owner", "me"], ["Owner", "other"]])
+        self.assertEqual(len(proxystub.multicalls), 1)
+        # Failed lookups are unknown, and are tried again
+        self.assertIsNone(roles.get_roles("unknown"))
+        self.assertEqual(len(proxystub.multicalls), 2)
+
+    @unittest.mock.patch("xmlrpc.client.ServerProxy", proxystub)
+    def test_batches(self):
+        with unittest.mock.patch("pyroma.roles.BATCH_SIZE", 2):
+            roles.prefetch(["complete", "one", "two", "three", "four"])
+        self.assertEqual([len(calls) for calls in proxystub.multicalls], [2, 2, 1])
+
+    def test_stale(self):
+        with unittest.mock.patch("xmlrpc.client.ServerProxy", proxystub):
+            roles.get_roles("complete")
+        roles.clear_memory()
+
+        # When PyPI can't be reached, old roles are better than none
+        with unittest.mock.patch("xmlrpc.client.ServerProxy", side_effect=OSError("Network is unreachable")):
+            with unittest.mock.patch("time.time", return_value=time.time() + roles.TTL + 1):
+                self.assertEqual(len(roles.get_roles("complete")), 3)
+            self.assertIsNone(roles.get_roles("other"))
+
+        # But when they are old, they are fetched again
+        with unittest.mock.patch("xmlrpc.client.ServerProxy", proxystub):
+            with unittest.mock.patch("time.time", return_value=time.time() + roles.TTL + 1):
+                roles.get_roles("complete")
+        self.assertEqual(len(proxystub.multicalls), 2)
+
+
+class BatchTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_discover(self):
+        found = [os.path.basename(path) for path in batch.discover(TESTDATA_DIR)]
+        self.assertEqual(
+            found,
+            ["complete", "custom_test", "lacking", "minimal", "pep517", "pep621", "private_classifier", "setup_config"],
+        )
+
+    def test_run_batch(self):
+        projects = [
+            ("directory", str(TESTDATA_DIR / "complete")),
+            ("directory", str(TESTDATA_DIR / "minimal")),
+            ("directory", str(TESTDATA_DIR / "nonexistent")),
+        ]
+        results = batch.run_batch(projects, jobs=2)
+
+        self.assertEqual([result[0] for result in results], [argument for mode, argument in projects])
+        self.assertEqual(results[0][1:], ("complete", 10, [], None))
+        self.assertEqual(results[1][1:3], ("minimal", 2))
+        self.assertEqual(results[1][3], RatingsTest("test_minimal")._get_file_rating("minimal")[1])
+        self.assertIsNotNone(results[2][4])
+
+        self.assertTrue(pyroma.run_many(projects, jobs=2, quiet=True))
+        self.assertFalse(pyroma.run_many(projects[:1], jobs=1, quiet=True))
+
+
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class StubMirrorHandler(QuietHTTPRequestHandler):
+    """Serves a mirror directory, with the Simple API pages as JSON"""
+
+    def guess_type(self, path):
+        if "/simple/" in path.replace(os.sep, "/"):
+            return pypidata.SIMPLE_JSON
+        return super().guess_type(path)
+
+
+class StubPyPIHandler(http.server.BaseHTTPRequestHandler):
+    """Serves JSON with an ETag or a Last-Modified header, and records the requests"""
+
+    protocol_version = "HTTP/1.1"
+    body = b'{"info": {"name": "stub"}}'
+    requests = []
+    # Files that are served with support for Range requests
+    files = {}
+
+    # Set to False to ignore Range headers
+    ranges = True
+    # Set to True to answer Range requests with the whole file, like a broken proxy
+    wrong_ranges = False
+
+    def _send_file(self, content):
+        start, end = 0, len(content)
+        if self.ranges and self.headers.get("Range"):
+            first, last = self.headers["Range"].split("=")[1].split("-")
+            if not first:
+                # The last bytes of the file
+                start = max(0, len(content) - int(last))
+            elif self.wrong_ranges:
+                start = 0
+            else:
+                start = int(first)
+                if last:
+                    end = min(int(last) + 1, len(content))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        self.wfile.write(content[start:end])
+
+    def do_GET(self):
+        self.requests.append((self.path, self.client_address[1], dict(self.headers)))
+        if self.path in self.files:
+            self._send_file(self.files[self.path])
+            return
+        if self.path == "/etag.json":
+            header, value, condition = "ETag", '"v1"', "If-None-Match"
+        else:
+            header, value, condition = "Last-Modified", "Wed, 21 Oct 2015 07:28:00 GMT", "If-Modified-Since"
+        if self.headers.get(condition) == value:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HungHandler(socketserver.BaseRequestHandler):
+    """Accepts connections, and never answers"""
+
+    connections = 0
+    release = threading.Event()
+
+    def handle(self):
+        HungHandler.connections += 1
+        self.release.wait(30)
+
+
+class HTTPCacheTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        cache.enable(self.tempdir)
+        StubPyPIHandler.requests = []
+        StubPyPIHandler.files = {}
+        StubPyPIHandler.ranges = True
+        StubPyPIHandler.wrong_ranges = False
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubPyPIHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        httpcache.reset_session()
+        cache.disable()
+        shutil.rmtree(self.tempdir)
+
+    def test_conditional_requests(self):
+        for path in ("/etag.json", "/modified.json"):
+            first = httpcache.get(self.base_url + path, conditional=True)
+            second = httpcache.get(self.base_url + path, conditional=True)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(second.status_code, 200)
+            self.assertEqual(first.json(), {"info": {"name": "stub"}})
+            self.assertEqual(second.json(), first.json())
+
+        # The second requests were conditional, and got a 304
+        etag, etag_again, modified, modified_again = StubPyPIHandler.requests
+        self.assertNotIn("If-None-Match", etag[2])
+        self.assertEqual(etag_again[2]["If-None-Match"], '"v1"')
+        self.assertNotIn("If-Modified-Since", modified[2])
+        self.assertEqual(modified_again[2]["If-Modified-Since"], "Wed, 21 Oct 2015 07:28:00 GMT")
+        self.assertEqual(cache.get_cache("http").hits, 2)
+
+        # All requests used the same connection
+        self.assertEqual(len({port for path, port, headers in StubPyPIHandler.requests}), 1)
+
+    def test_unconditional(self):
+        httpcache.get(self.base_url + "/etag.json")
+        httpcache.get(self.base_url + "/etag.json")
+        self.assertNotIn("If-None-Match", StubPyPIHandler.requests[1][2])
+        self.assertEqual(list(cache.get_cache("http").items()), [])
+
+    def test_download(self):
+        content = (TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz").read_bytes()
+        sha256 = hashlib.sha256(content).hexdigest()
+        StubPyPIHandler.files = {"/complete-1.0.dev1.tar.gz": content}
+        url = self.base_url + "/complete-1.0.dev1.tar.gz"
+        path = os.path.join(self.tempdir, "complete-1.0.dev1.tar.gz")
+
+        with unittest.mock.patch("pyroma.pypidata.CHUNK_SIZE", 1000):
+            self.assertEqual(pypidata.download_file(url, path, sha256), sha256)
+        self.assertEqual(Path(path).read_bytes(), content)
+        self.assertFalse(os.path.exists(path + ".part"))
+
+        # An interrupted download is resumed
+        os.unlink(path)
+        Path(path + ".part").write_bytes(content[:1000])
+        self.assertEqual(pypidata.download_file(url, path, sha256), sha256)
+        self.assertEqual(Path(path).read_bytes(), content)
+        self.assertEqual(StubPyPIHandler.requests[-1][2]["Range"], "bytes=1000-")
+
+        # A download that doesn't match the digest is an error, and is removed
+        os.unlink(path)
+        with self.assertRaises(ValueError):
+            pypidata.download_file(url, path, "0" * 64)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".part"))
+
+        # If the server answers with another part of the file, it's downloaded from the beginning
+        StubPyPIHandler.wrong_ranges = True
+        StubPyPIHandler.requests = []
+        Path(path + ".part").write_bytes(content[:1000])
+        self.assertEqual(pypidata.download_file(url, path), sha256)
+        self.assertEqual(Path(path).read_bytes(), content)
+        self.assertEqual([headers.get("Range") for p, port, headers in StubPyPIHandler.requests], ["bytes=1000-", None])
+
+    def test_remote_file(self):
+        path = TESTDATA_DIR / "distributions" / "pyroma_pep621_test_pkg-1.0-py3-none-any.whl"
+        StubPyPIHandler.files = {"/test.whl": path.read_bytes()}
+
+        remote = httpcache.RemoteFile(self.base_url + "/test.whl", block_size=1024)
+        self.assertEqual(remote.size, path.stat().st_size)
+        self.assertEqual(distributiondata.read_wheel_metadata(remote), distributiondata.read_wheel_metadata(path))
+        # The table of contents and the METADATA, not the whole wheel
+        self.assertLessEqual(remote.requests, 3)
+        self.assertTrue(all(headers["Range"] for path, port, headers in StubPyPIHandler.requests))
+
+        # Reading it all gives the whole file
+        remote.seek(0)
+        self.assertEqual(remote.read(), path.read_bytes())
+
+        StubPyPIHandler.ranges = False
+        with self.assertRaises(httpcache.RangeNotSupported):
+            httpcache.RemoteFile(self.base_url + "/test.whl")
+
+    def test_remote_wheel_metadata(self):
+        path = TESTDATA_DIR / "distributions" / "pyroma_pep621_test_pkg-1.0-py3-none-any.whl"
+        content = path.read_bytes()
+        StubPyPIHandler.files = {"/packages/ab/cd/test.whl": content}
+        index = pypidata.HTTPIndex(self.base_url)
+        expected = distributiondata.read_wheel_metadata(path)
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        self.assertEqual(
+            index.read_wheel_metadata("https://files.pythonhosted.org/packages/ab/cd/test.whl", sha256), expected
+        )
+        # Without support for Range requests, the whole wheel is downloaded
+        StubPyPIHandler.ranges = False
+        StubPyPIHandler.requests = []
+        self.assertEqual(index.read_wheel_metadata(self.base_url + "/packages/ab/cd/test.whl", sha256), expected)
+        self.assertEqual(len(StubPyPIHandler.requests), 2)
+
+    def test_hung_server(self):
+        HungHandler.connections = 0
+        HungHandler.release.clear()
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), HungHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            start = time.monotonic()
+            with deadline.limit(1):
+                with self.assertRaises(deadline.DeadlineExceeded):
+                    pypidata._get(url + "/pypi/stub/json", "fetching the project data")
+            # The request is not retried after the deadline
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(HungHandler.connections, 1)
+
+            with deadline.limit(1):
+                with self.assertRaises(deadline.DeadlineExceeded):
+                    pypidata.HTTPIndex(url).read_wheel_metadata(url + "/test.whl", None)
+        finally:
+            HungHandler.release.set()
+            server.shutdown()
+            server.server_close()
+
+    def test_distribution_data(self):
+        content = (TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz").read_bytes()
+        sha256 = hashlib.sha256(content).hexdigest()
+        StubPyPIHandler.files = {"/complete-1.0.dev1.tar.gz": content}
+        url = self.base_url + "/complete-1.0.dev1.tar.gz"
+
+        self.assertEqual(pypidata._get_distribution_data(url, sha256), COMPLETE)
+        # The download is not kept
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "downloads", sha256)), [])
+
+        # The second time the data comes from the cache, and nothing is downloaded
+        count = len(StubPyPIHandler.requests)
+        self.assertEqual(pypidata._get_distribution_data(url, sha256), COMPLETE)
+        self.assertEqual(len(StubPyPIHandler.requests), count)
+
+
+class IndexTest(unittest.TestCase):
+    """Rating packages from a mirror, with no access to PyPI"""
+
+    maxDiff = None
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        web = os.path.join(self.tempdir, "web")
+        with open(TESTDATA_DIR / "jsondata" / "complete.json", encoding="UTF-8") as file:
+            project_data = json.load(file)
+        content = (TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz").read_bytes()
+        sdist = project_data["releases"]["1.1.0"][0]
+        sdist["digests"]["sha256"] = hashlib.sha256(content).hexdigest()
+
+        packages_path = os.path.join(web, "packages", *sdist["url"].split("/packages/")[1].split("/"))
+        os.makedirs(os.path.dirname(packages_path))
+        Path(packages_path).write_bytes(content)
+        self.web = web
+        self.sdist_path = packages_path
+        os.makedirs(os.path.join(web, "json"))
+        os.makedirs(os.path.join(web, "pypi", "complete"))
+        for filename in (os.path.join(web, "json", "complete"), os.path.join(web, "pypi", "complete", "json")):
+            with open(filename, "w", encoding="UTF-8") as file:
+                json.dump(project_data, file)
+
+        # The owners may not be fetched from PyPI
+        self.patch = unittest.mock.patch("xmlrpc.client.ServerProxy", side_effect=AssertionError("XML-RPC was used"))
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        pypidata.set_index_url(None)
+        httpcache.reset_session()
+        shutil.rmtree(self.tempdir)
+
+    def _check(self, data):
+        self.assertEqual(data["name"], "complete")
+        self.assertTrue(data["_source_download"])
+        # Mirrors don't know the owners
+        self.assertNotIn("_owners", data)
+        self.assertEqual(rate(data)[0], 10)
+
+    def test_file_index(self):
+        for url in (Path(self.tempdir).as_uri(), os.path.join(self.tempdir, "web")):
+            pypidata.set_index_url(url)
+            with unittest.mock.patch("pyroma.httpcache.get_session", side_effect=AssertionError("HTTP was used")):
+                self._check(pypidata.get_data("Complete"))
+                with self.assertRaises(ValueError) as context:
+                    pypidata.get_data("missing")
+                self.assertIn("Did not find 'missing' in the mirror", str(context.exception))
+
+    def _serve(self):
+        handler = functools.partial(StubMirrorHandler, directory=self.web)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def _add_core_metadata(self, sha256=None, key="core-metadata"):
+        """Adds a PEP 658 metadata file for the sdist, and the Simple API page that tells about it"""
+        metadata = b"Metadata-Version: 2.1\nName: complete\nVersion: 1.1.0\nProvides-Extra: test\n\nComplete\n"
+        Path(self.sdist_path + ".metadata").write_bytes(metadata)
+        simple_dir = os.path.join(self.web, "simple", "complete")
+        os.makedirs(simple_dir)
+        files = [
+            {
+                "filename": os.path.basename(self.sdist_path),
+                "url": "../../packages/" + self.sdist_path.split("/packages/")[1],
+                "hashes": {},
+                key: {"sha256": sha256 or hashlib.sha256(metadata).hexdigest()},
+            }
+        ]
+        with open(os.path.join(simple_dir, "index.html"), "w", encoding="UTF-8") as file:
+            json.dump({"meta": {"api-version": "1.1"}, "name": "complete", "files": files}, file)
+
+    def test_core_metadata(self):
+        self._add_core_metadata()
+        for url in (self._serve(), os.path.join(self.tempdir, "web")):
+            pypidata.set_index_url(url)
+            with unittest.mock.patch("pyroma.distributiondata.get_data", side_effect=AssertionError("Built")):
+                data = pypidata.get_data("complete", metadata_only=True)
+            self.assertEqual(data["provides-extra"], "test")
+            self.assertTrue(data["_has_sdist"])
+            self.assertFalse(data["_source_download"])
+            # The PyPI data wins
+            self.assertNotEqual(data["description"], "Complete\n")
+            self.assertEqual(rate(data)[0], 10)
+
+            # Without metadata_only the sdist is built
+            self.assertTrue(pypidata.get_data("complete")["_source_download"])
+
+    def test_old_core_metadata_key(self):
+        # Indexes from before PEP 714 have the dist-info-metadata key
+        self._add_core_metadata(key="dist-info-metadata")
+        pypidata.set_index_url(self._serve())
+        with unittest.mock.patch("pyroma.distributiondata.get_data", side_effect=AssertionError("Built")):
+            data = pypidata.get_data("complete", metadata_only=True)
+        self.assertEqual(data["provides-extra"], "test")
+
+    def test_simple_html(self):
+        parser = pypidata.SimpleHTMLParser()
+        parser.feed(
+            '<html><body><a href="../../packages/ab/cd/foo-1.0.tar.gz#sha256=123">foo-1.0.tar.gz</a>'
+            '<a href="../../packages/ab/cd/foo-1.0-py3-none-any.whl#sha256=456" data-core-metadata="sha256=789">'
+            "foo-1.0-py3-none-any.whl</a>"
+            '<a href="../../packages/ab/cd/foo-0.9-py3-none-any.whl" data-dist-info-metadata="true">'
+            "foo-0.9-py3-none-any.whl</a>"
+            '<a href="../../packages/ab/cd/foo-0.8-py3-none-any.whl" data-core-metadata="false">'
+            "foo-0.8-py3-none-any.whl</a></body></html>"
+        )
+        self.assertEqual(parser.files, {"foo-1.0-py3-none-any.whl": "789", "foo-0.9-py3-none-any.whl": None})
+
+    def test_wrong_core_metadata(self):
+        self._add_core_metadata(sha256="0" * 64)
+        pypidata.set_index_url(self._serve())
+        with self.assertRaises(ValueError):
+            pypidata.get_data("complete", metadata_only=True)
+
+    def test_no_core_metadata(self):
+        # Without the metadata files, the sdist is built
+        for url in (self._serve(), os.path.join(self.tempdir, "web")):
+            pypidata.set_index_url(url)
+            self._check(pypidata.get_data("complete", metadata_only=True))
+
+    def test_http_index(self):
+        url = self._serve()
+        urls = []
+        session_get = httpcache.get_session().get
+
+        def get(fetched, **kwargs):
+            urls.append(fetched)
+            return session_get(fetched, **kwargs)
+
+        pypidata.set_index_url(url)
+        with unittest.mock.patch.object(httpcache.get_session(), "get", get):
+            self._check(pypidata.get_data("complete"))
+            with self.assertRaises(ValueError) as context:
+                pypidata.get_data("missing")
+            self.assertIn(f"Did not find 'missing' on {url}", str(context.exception))
+
+        # The JSON data and the sdist both came from the mirror
+        self.assertEqual(len(urls), 3)
+        self.assertTrue(all(fetched.startswith(url + "/") for fetched in urls))
+        self.assertIn("/packages/", urls[1])
+
+
+class DepTreeTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_requirements(self):
+        data = {
+            "requires-dist": [
+                "Requests>=2.0",
+                "zope.interface",
+                "pytest; extra == 'test'",
+                "tomli; python_version < '3'",
+                "requests[socks]",
+                "not a valid requirement!",
+            ]
+        }
+        self.assertEqual(deptree.requirements(data), ["requests", "zope-interface"])
+        self.assertEqual(deptree.requirements({"requires-dist": "Foo"}), ["foo"])
+        self.assertEqual(deptree.requirements({"requires-dist": None}), [])
+
+    def test_rate_tree(self):
+        projects = {
+            "top": ["Middle", "shared"],
+            "middle": ["shared", "bottom"],
+            "shared": ["top"],  # A cycle
+            "bottom": ["missing"],
+        }
+        calls = []
+
+        def get_data(project, metadata_only=None):
+            calls.append(project)
+            if project.lower() not in projects:
+                raise ValueError(f"Did not find '{project}' on PyPI. Did you misspell it?")
+            data = COMPLETE.copy()
+            data["name"] = project.lower()
+            data["requires-dist"] = projects[project.lower()]
+            return data
+
+        with unittest.mock.patch("pyroma.pypidata.get_data", get_data):
+            root, nodes = deptree.rate_tree("pypi", "Top", jobs=4)
+            # Each project is rated once
+            self.assertEqual(sorted(calls), ["Top", "bottom", "middle", "missing", "shared"])
+            self.assertEqual(root, "top")
+            self.assertEqual(nodes["middle"].rating, 10)
+            self.assertIn("misspell", nodes["missing"].error)
+            self.assertEqual(
+                deptree.tree(root, nodes),
+                [
+                    "top 10/10",
+                    "|-- middle 10/10",
+                    "|   |-- bottom 10/10",
+                    "|   |   `-- missing: ValueError: Did not find 'missing' on PyPI. Did you misspell it?",
+                    "|   `-- shared 10/10",
+                    "|       `-- top 10/10 (dependencies listed above)",
+                    "`-- shared 10/10 (dependencies listed above)",
+                ],
+            )
+
+            calls = []
+            root, nodes = deptree.rate_tree("pypi", "top", max_depth=1)
+            self.assertEqual(sorted(calls), ["middle", "shared", "top"])
+            # The dependencies of middle and shared that weren't rated are left out
+            self.assertEqual(
+                deptree.tree(root, nodes),
+                [
+                    "top 10/10",
+                    "|-- middle 10/10",
+                    "|   `-- shared 10/10",
+                    "|       `-- top 10/10 (dependencies listed above)",
+                    "`-- shared 10/10 (dependencies listed above)",
+                ],
+            )
+
+
+class HistoryTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        with open(TESTDATA_DIR / "jsondata" / "complete.json", encoding="UTF-8") as file:
+            self.project_data = json.load(file)
+
+    def test_select_releases(self):
+        self.project_data["releases"]["bad version"] = self.project_data["releases"]["2.4"]
+        self.project_data["releases"]["3.0"] = []
+        releases = history.select_releases(self.project_data)
+        # Invalid versions and releases without files are left out
+        self.assertEqual(len(releases), 29)
+        self.assertEqual(releases[:3], ["0.6.4", "0.6.6", "0.6.7"])
+        self.assertEqual(releases[-1], "2.4")
+        self.assertEqual(
+            history.select_releases(self.project_data, ">=0.6.8,<1.0.0a2"), ["0.6.8", "0.6.9", "0.6.10", "1.0.0a1"]
+        )
+        self.assertEqual(history.release_date(self.project_data["releases"]["2.4"]), "2019-10-09")
+
+    def test_rate_history(self):
+        calls = []
+        OWNERS = [["Owner", "regebro"], ["Owner", "ivan"], ["Maintainer", "mgedmin"], ["Owner", "someone"]]
+
+        def get_project_data(project, index=None):
+            calls.append(project)
+            return self.project_data
+
+        def get_distribution_data(url, sha256):
+            version = url.split("/")[-1].split("-")[1].rsplit(".", 1)[0].replace(".tar", "")
+            if version == "0.6.9":
+                raise ValueError("Broken sdist")
+            data = COMPLETE.copy()
+            data["version"] = version
+            if version.startswith("0."):
+                del data["keywords"]
+            return data
+
+        with unittest.mock.patch("pyroma.pypidata._get_project_data", get_project_data):
+            with unittest.mock.patch("pyroma.pypidata._get_distribution_data", get_distribution_data):
+                with unittest.mock.patch("pyroma.pypidata._get_roles", lambda project: OWNERS):
+                    name, releases = history.rate_history("complete", ">=0.6.8,<=1.1.0", jobs=4)
+
+        # The project data was only fetched once
+        self.assertEqual(calls, ["complete"])
+        self.assertEqual(name, "complete")
+        versions = ["0.6.8", "0.6.9", "0.6.10", "1.0.0", "1.0.0a1", "1.0.0a2", "1.0.0a3.dev0"]
+        versions += ["1.0.0a4.dev0", "1.0.0a5", "1.0.0a6", "1.1.0"]
+        self.assertEqual(
+            [release.version for release in releases],
+            sorted(versions, key=Version),
+        )
+        self.assertEqual(releases[0].problems, ["Your package does not have keywords data."])
+        self.assertEqual(releases[0].rating, 9)
+        self.assertIn("Broken sdist", releases[1].error)
+        self.assertEqual(releases[3].rating, 10)
+
+        lines = history.trend(releases)
+        self.assertEqual(
+            lines[:6],
+            [
+                "Version       Released    Rating  Change",
+                "0.6.8         2015-04-02   9/10",
+                "0.6.9         2015-04-02  Error: ValueError: Broken sdist",
+                "0.6.10        2015-04-02   9/10",
+                "1.0.0a1       2018-04-10  10/10   +1",
+                "1.0.0a2       2018-04-10  10/10",
+            ],
+        )
+
+
+def publish_errors(source):
+    """The errors that publish_parts() reports for a ReST text, like ValidREST did before it only parsed it"""
+    from docutils.core import publish_parts
+    from docutils.utils import SystemMessage
+
+    stream = io.StringIO()
+    try:
+        publish_parts(source=source, writer="html4css1", settings_overrides={"warning_stream": stream})
+    except SystemMessage:
+        pass
+    errors = stream.getvalue().strip()
+    return "\n" + errors if errors else None
+
+
+class ValidRESTTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_same_errors(self):
+        sources = [
+            long_description,
+            "Title\n===\n\nThis is `broken\n",
+            "See `nowhere`_.\n",
+            ".. _a: https://example.com/a\n.. _a: https://example.com/b\n\n`a`_\n",
+            "A footnote [#]_ without a body.\n",
+            "An |undefined| substitution.\n",
+            ".. nodirective:: foo\n",
+            ":norole:`foo`\n",
+            "Title\n=====\n\nOne\n---\n\nTwo\n~~~\n\nThree\n---\n\nBad\n~~~\n",
+            "* item\n  more\n not indented\n",
+            "Text\n\n----\n\n----\n",
+            "=====\nTitle\n=====\n\n=====\nTitle\n=====\n",
+        ]
+        for source in sources:
+            self.assertEqual(ratings._check_rest(source), publish_errors(source), source)
+
+
+class ImportTimeTest(unittest.TestCase):
+    # The slow dependencies, that should only be imported when they are needed
+    HEAVY = {"build", "docutils.core", "requests", "setuptools", "check_manifest", "xmlrpc.client"}
+    # A generous budget in seconds, importing pyroma takes less than a tenth of that
+    BUDGET = 0.5
+
+    def _run(self, *args):
+        return subprocess.run(
+            [sys.executable, *args],
+            capture_output=True,
+            encoding="UTF-8",
+            cwd=Path(__file__).parent.parent,
+            env=dict(os.environ, PYROMA_CACHE_DIR=tempfile.gettempdir()),
+        )
+
+    def test_import(self):
+        result = self._run("-X", "importtime", "-c", "import pyroma")
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:"):
+                self_time, cumulative, name = line.split(":", 1)[1].split("|")
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative) / 1000000
+        self.assertFalse(self.HEAVY & set(times), "Heavy dependencies imported")
+        self.assertLess(times["pyroma"], self.BUDGET)
+
+    def test_wheel(self):
+        wheel = TESTDATA_DIR / "distributions" / "pyroma_pep621_test_pkg-1.0-py3-none-any.whl"
+        code = (
+            "import json, sys\n"
+            f"sys.argv = ['pyroma', '-q', '--no-cache', '-f', {str(wheel)!r}]\n"
+            "import pyroma\n"
+            "try:\n"
+            "    pyroma.main()\n"
+            "except SystemExit:\n"
+            "    print(json.dumps(sorted(sys.modules)), file=sys.stderr)\n"
+        )
+        result = self._run("-c", code)
+        self.assertEqual(result.stdout.strip(), "10")
+        modules = set(json.loads(result.stderr))
+        self.assertIn("pyroma.distributiondata", modules)
+        self.assertFalse(self.HEAVY & modules, "Heavy dependencies imported")
+
+
 class DistroDataTest(unittest.TestCase):
     maxDiff = None
 
@@ -345,3 +1506,258 @@ class DistroDataTest(unittest.TestCase):
             if filename.startswith("complete"):
                 data = distributiondata.get_data(directory / filename)
                 self.assertEqual(data, COMPLETE)
+
+    def test_static_pkg_info(self):
+        path = TESTDATA_DIR / "distributions" / "pyroma_pep621_test_pkg-1.0.tar.gz"
+        with unittest.mock.patch("pyroma.projectdata.get_build_data") as build_mock:
+            data = distributiondata.get_data(path)
+            self.assertFalse(build_mock.called)
+
+        built = distributiondata.get_build_data(path, "pyroma_pep621_test_pkg-1.0", ".gz")
+        for key in projectdata.CHECKED_FIELDS - {"description"}:
+            self.assertEqual(data.get(key), built.get(key))
+        self.assertEqual(data["description"].strip(), built["description"].strip())
+        self.assertEqual(rate(data), (10, []))
+
+    def test_wheel(self):
+        path = TESTDATA_DIR / "distributions" / "pyroma_pep621_test_pkg-1.0-py3-none-any.whl"
+        with unittest.mock.patch("pyroma.projectdata.get_build_data") as build_mock:
+            data = distributiondata.get_data(path)
+            self.assertFalse(build_mock.called)
+
+        sdist_data = distributiondata.get_data(TESTDATA_DIR / "distributions" / "pyroma_pep621_test_pkg-1.0.tar.gz")
+        self.assertEqual(data, sdist_data)
+        self.assertEqual(rate(data), (10, []))
+
+    def _make_tar(self, tempdir, files):
+        path = os.path.join(tempdir, "test-1.0.tar.gz")
+        with tarfile.open(path, "w:gz") as tar:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        return path
+
+    def test_path_traversal(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = self._make_tar(tempdir, {"test-1.0/setup.py": b"", "../evil.txt": b"Evil"})
+            extract_dir = os.path.join(tempdir, "extract")
+            os.mkdir(extract_dir)
+            with self.assertRaises(Exception) as context:
+                distributiondata._extract_tar(path, extract_dir)
+            self.assertIn("path traversal", str(context.exception))
+            self.assertFalse(os.path.exists(os.path.join(tempdir, "evil.txt")))
+
+    def test_skip_large_files(self):
+        big = b"x" * 2000
+        files = {
+            "test-1.0/setup.py": big,
+            "test-1.0/README.rst": big,
+            "test-1.0/data/big.bin": big,
+            "test-1.0/data/small.bin": b"x",
+        }
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = self._make_tar(tempdir, files)
+            with unittest.mock.patch("pyroma.distributiondata.SKIP_SIZE", 1000):
+                for skip, expected in ((True, True), (False, False)):
+                    extract_dir = tempfile.mkdtemp(dir=tempdir)
+                    self.assertEqual(distributiondata._extract_tar(path, extract_dir, skip), expected)
+                    extracted = {
+                        os.path.relpath(os.path.join(root, name), extract_dir)
+                        for root, dirs, names in os.walk(extract_dir)
+                        for name in names
+                    }
+                    if skip:
+                        self.assertEqual(extracted, set(files) - {"test-1.0/data/big.bin"})
+                    else:
+                        self.assertEqual(extracted, set(files))
+
+    def test_extract_dir(self):
+        path = TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz"
+        with tempfile.TemporaryDirectory() as tempdir:
+            distributiondata.set_extract_dir(tempdir)
+            try:
+                data = distributiondata.get_build_data(path, "complete-1.0.dev1", ".gz")
+            finally:
+                distributiondata.set_extract_dir(None)
+            self.assertEqual(data, COMPLETE)
+            # The temporary directory was used and cleaned up
+            self.assertEqual(os.listdir(tempdir), [])
+
+    def test_dynamic_pkg_info(self):
+        files = {"PKG-INFO": b"Metadata-Version: 2.2\nName: foo\nVersion: 1.0\nDynamic: Classifier\n\nFoo\n"}
+        self.assertIsNone(distributiondata.get_pkg_info_data(files))
+
+        files["PKG-INFO"] = files["PKG-INFO"].replace(b"Classifier", b"License-File")
+        data = distributiondata.get_pkg_info_data(files)
+        self.assertEqual(data["name"], "foo")
+        self.assertTrue(data["_missing_pyproject_toml"])
+
+        files["PKG-INFO"] = files["PKG-INFO"].replace(b"2.2", b"2.1")
+        self.assertIsNone(distributiondata.get_pkg_info_data(files))
+
+
+class CacheTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        cache.enable(os.path.join(self.tempdir, "cache"))
+        self.projectdir = os.path.join(self.tempdir, "complete")
+        shutil.copytree(TESTDATA_DIR / "complete", self.projectdir)
+
+    def tearDown(self):
+        cache.disable()
+        shutil.rmtree(self.tempdir)
+
+    def test_metadata_cache(self):
+        metadata_cache = cache.get_cache("metadata")
+        hits = metadata_cache.hits
+
+        data = projectdata.get_data(self.projectdir)
+        del data["_path"]
+        self.assertEqual(data, COMPLETE)
+
+        # The second time the backend isn't called
+        with unittest.mock.patch("pyroma.projectdata.build_metadata") as build_mock:
+            data = projectdata.get_data(self.projectdir)
+            del data["_path"]
+            self.assertEqual(data, COMPLETE)
+            self.assertFalse(build_mock.called)
+        self.assertEqual(metadata_cache.hits, hits + 1)
+
+        # Changing the description invalidates the cache
+        with open(os.path.join(self.projectdir, "README.txt"), "a", encoding="UTF-8") as readme:
+            readme.write("\nMore text.\n")
+        data = projectdata.get_data(self.projectdir)
+        self.assertEqual(data["description"], COMPLETE["description"] + "\nMore text.\n")
+
+        # And it can be emptied
+        cache.clear()
+        self.assertEqual(os.listdir(metadata_cache.directory), [])
+
+    def test_build_history(self):
+        # Pretend a non isolated build was tried and failed
+        metadata = build.util.project_wheel_metadata(self.projectdir, isolated=False)
+        calls = []
+
+        def wheel_metadata(path, isolated):
+            calls.append(isolated)
+            if not isolated:
+                raise build.BuildException("Missing dependencies")
+            return metadata
+
+        with unittest.mock.patch("pyroma.projectdata._wheel_metadata", wheel_metadata):
+            projectdata.wheel_metadata(self.projectdir)
+            self.assertEqual(calls, [False, True])
+
+            # The next time the isolated build is tried first
+            projectdata.wheel_metadata(self.projectdir)
+            self.assertEqual(calls, [False, True, True])
+
+            # As is it for other projects with the same build requirements
+            otherdir = os.path.join(self.tempdir, "other")
+            shutil.copytree(self.projectdir, otherdir)
+            projectdata.wheel_metadata(otherdir)
+            self.assertEqual(calls, [False, True, True, True])
+
+            # But if the build requirements change, the history doesn't apply
+            with open(os.path.join(otherdir, "pyproject.toml"), "w", encoding="UTF-8") as pyproject:
+                pyproject.write('[build-system]\nrequires = ["setuptools>=61"]\n')
+            projectdata.wheel_metadata(otherdir)
+            self.assertEqual(calls, [False, True, True, True, False, True])
+
+        history = projectdata.build_history()
+        self.assertEqual(len(history), 4)  # Two projects, two sets of requirements
+        self.assertTrue(all(record["isolated"] for record in history))
+        self.assertIn(os.path.abspath(self.projectdir), [record["path"] for record in history])
+
+    def test_build_history_of_distribution(self):
+        # The directory an sdist is extracted to is removed, so only the backend is recorded
+        distributiondata.get_data(TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz")
+        history = projectdata.build_history()
+        self.assertEqual(len(history), 1)
+        self.assertIsNone(history[0]["path"])
+
+    def test_disabled(self):
+        cache.disable()
+        projectdata.get_data(self.projectdir)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "cache")))
+
+    def test_distribution_cache(self):
+        path = TESTDATA_DIR / "distributions" / "complete-1.0.dev1.tar.gz"
+        data, rating = distributiondata.get_rating(path, ["CheckManifest"])
+        self.assertEqual(data, COMPLETE)
+
+        # The second time nothing is extracted, built or rated
+        with unittest.mock.patch("pyroma.distributiondata._get_data") as data_mock:
+            with unittest.mock.patch("pyroma.ratings.rate") as rate_mock:
+                self.assertEqual(distributiondata.get_rating(path, ["CheckManifest"]), (data, rating))
+                self.assertEqual(distributiondata.get_data(path), data)
+                self.assertFalse(data_mock.called)
+                self.assertFalse(rate_mock.called)
+
+        # Other skipped tests are rated again, but not extracted
+        with unittest.mock.patch("pyroma.distributiondata._get_data") as data_mock:
+            data, rating = distributiondata.get_rating(path)
+            self.assertFalse(data_mock.called)
+        self.assertEqual(rating, rate(COMPLETE))
+
+        # The key is the content, not the file name
+        with tempfile.TemporaryDirectory() as tempdir:
+            copy = os.path.join(tempdir, "copy.tar.gz")
+            shutil.copy(path, copy)
+            with unittest.mock.patch("pyroma.distributiondata._get_data") as data_mock:
+                self.assertEqual(distributiondata.get_data(copy), COMPLETE)
+                self.assertFalse(data_mock.called)
+
+        # A new docutils may validate the description differently, so the file is rated again, but not extracted
+        with unittest.mock.patch("docutils.__version__", "0.0"):
+            with unittest.mock.patch("pyroma.distributiondata._get_data") as data_mock:
+                with unittest.mock.patch("pyroma.ratings.rate", wraps=rate) as rate_mock:
+                    self.assertEqual(
+                        distributiondata.get_rating(path, ["CheckManifest"]), (data, rate(data, ["CheckManifest"]))
+                    )
+                    self.assertTrue(rate_mock.called)
+                    self.assertFalse(data_mock.called)
+
+    def test_rest_cache(self):
+        ratings.clear_rest_cache()
+        invalid = "Title\n=====\n\nThis is `broken\n"
+        errors = ratings.check_rest(invalid)
+        self.assertIn("start-string without end-string", errors)
+        self.assertIsNone(ratings.check_rest(long_description))
+
+        # The second time it's not parsed again
+        with unittest.mock.patch("pyroma.ratings._check_rest") as check_mock:
+            self.assertEqual(ratings.check_rest(invalid), errors)
+            self.assertIsNone(ratings.check_rest(long_description))
+            self.assertFalse(check_mock.called)
+
+            # It's also in the disk cache
+            ratings.clear_rest_cache()
+            self.assertEqual(ratings.check_rest(invalid), errors)
+            self.assertFalse(check_mock.called)
+
+        # The results in memory are limited to REST_CACHE_SIZE descriptions
+        with unittest.mock.patch("pyroma.ratings.REST_CACHE_SIZE", 2):
+            for text in ("one", "two", "three"):
+                ratings.check_rest(text)
+            self.assertEqual(len(ratings._rest_results), 2)
+        ratings.clear_rest_cache()
+
+        data = dict(COMPLETE, description=invalid)
+        self.assertIn("Your Description is not valid ReST: " + errors, rate(data)[1])
+
+    def test_eviction(self):
+        test_cache = cache.Cache("test", max_size=250)
+        for key in "abc":
+            test_cache.set(key, "x" * 100)
+            os.utime(test_cache._filename(key), (0, ord(key)))
+        # The oldest was removed to make room
+        self.assertEqual([key for key, value in test_cache.items()], ["b", "c"])
+
+        # Using an entry makes it the most recently used
+        test_cache.get("b")
+        test_cache.set("d", "x" * 100)
+        self.assertEqual([key for key, value in test_cache.items()], ["b", "d"])